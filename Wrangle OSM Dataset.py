@@ -8,15 +8,29 @@ Created on Tue Jan 17 16:19:36 2017
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import xml.etree.cElementTree as ET  # Use cElementTree or lxml if too slow
-from collections import defaultdict
+try:
+    import xml.etree.cElementTree as ET  # Use cElementTree or lxml if too slow
+except ImportError:
+    import xml.etree.ElementTree as ET  # cElementTree was removed in Python 3.9
+from collections import defaultdict, Counter, OrderedDict
 import re
 import pprint
 import string
 import codecs
 import json
 import os
-from pymongo import MongoClient
+import math
+import hashlib
+import sqlite3
+import mmap
+import multiprocessing
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+try:
+    unichr
+except NameError:
+    unichr = chr
 
 
 class OSMFile(object):
@@ -111,15 +125,41 @@ class CleanStreets(object):
     Clean Streets of OSM File
     From Udacity
     '''
-    def __init__(self, sample_file):
+    def __init__(self, sample_file, postcode_index=None, min_count=2, max_distance=2,
+                 min_confidence=0.8, dominance_ratio=10.0, min_body_length=7):
         '''
-        Initialize a Clean Streets instance, saves all parameters as attributes 
-        of the instance. Finds and returns all instances of unexpected 
+        Initialize a Clean Streets instance, saves all parameters as attributes
+        of the instance. Finds and returns all instances of unexpected
         street suffixes.
 
-        sample_file: Sampled OSM output file, created in given sample_file 
-                     path (a string)        
-        
+        sample_file: Sampled OSM output file, created in given sample_file
+                     path (a string)
+
+        postcode_index: Optional postcode boundary index, used to check
+                        node postcodes against their GPS position
+                        (a PostcodeIndex object or None)
+
+        min_count: Minimum number of times a clean street name must be found
+                   to be canonical, used by fuzzyClean (a positive integer)
+
+        max_distance: Maximum edit distance between a street name and its
+                      canonical street name, used by fuzzyClean
+                      (a positive integer)
+
+        min_confidence: Minimum match confidence for a street name to be
+                        replaced, used by fuzzyClean (a float between 0 and 1)
+
+        dominance_ratio: Minimum ratio of the canonical street name count to
+                         a street name count for the street name to be
+                         replaced, used by fuzzyClean (a float greater than 1)
+
+        min_body_length: Minimum length of a street name body, such as
+                         'Flatbush' of 'Flatbush Avenue', for a match to be
+                         replaced by fuzzyClean, shorter bodies such as
+                         'Bean' or 'Berger' are only suggested, as one edit
+                         is as likely another real street (a positive
+                         integer)
+
         street_type_re: Regex created to find the street suffix for 
                         tag attributes. (a regex)
                         
@@ -133,6 +173,25 @@ class CleanStreets(object):
                             street names (a dictionary of strings)
                             
         expected_zip: List of valid Brooklyn zip codes (a list of strings)
+
+        street_counts: Number of times each street name is found by the last
+                       audit (a Counter of strings)
+
+        street_index: Canonical street name index built by fuzzyClean
+                      (a StreetIndex object or None)
+
+        suggestions: Street names as keys, canonical street name and match
+                     confidence found by fuzzyClean but not replaced, for
+                     review, as values (a dictionary of tuples)
+
+        stats: Number of node, way and relation elements, and of street and
+               postcode tags, found by the last audit (a Counter of strings)
+
+        rules_version: Hash of the cleaning rules, expected, dirty to clean
+                       streets, clean streets, expected zip codes, fuzzy
+                       matching parameters and postcode boundaries, used to
+                       version cached audit results
+                       (a string)
         '''
         self.sample_file = sample_file
         self.street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
@@ -285,10 +344,21 @@ class CleanStreets(object):
                              '11237', 
                              '11238', 
                              '11239']
+        self.postcode_index = postcode_index
+        self.min_count = min_count
+        self.max_distance = max_distance
+        self.min_confidence = min_confidence
+        self.dominance_ratio = dominance_ratio
+        self.min_body_length = min_body_length
+        self.street_counts = Counter()
+        self.street_index = None
+        self.suggestions = {}
+        self.stats = Counter()
+        self.rules_version = self.createRulesVersion()
+
+
+
 
-        
-        
-        
     def getSampleFile(self):
         '''
         @return sample file name and/or directory. (a string)
@@ -327,7 +397,102 @@ class CleanStreets(object):
         @return list of expected zip codes for Brooklyn. (a list of strings)
         '''
         return self.expected_zip
-        
+
+    def getPostcodeIndex(self):
+        '''
+        @return postcode boundary index. (a PostcodeIndex object or None)
+        '''
+        return self.postcode_index
+
+    def getFuzzyParameters(self):
+        '''
+        @return fuzzyClean min_count, max_distance, min_confidence,
+                dominance_ratio and min_body_length. (a dictionary of numbers)
+        '''
+        return {'min_count' : self.min_count,
+                'max_distance' : self.max_distance,
+                'min_confidence' : self.min_confidence,
+                'dominance_ratio' : self.dominance_ratio,
+                'min_body_length' : self.min_body_length}
+
+    def getStreetCounts(self):
+        '''
+        @return number of times each street name is found by the last audit.
+                (a Counter of strings)
+        '''
+        return self.street_counts
+
+    def getStreetIndex(self):
+        '''
+        @return canonical street name index. (a StreetIndex object or None)
+        '''
+        return self.street_index
+
+    def getSuggestions(self):
+        '''
+        @return street name matches found by fuzzyClean but not replaced.
+                (a dictionary of tuples)
+        '''
+        return self.suggestions
+
+    def getStats(self):
+        '''
+        @return element and tag counts found by the last audit.
+                (a Counter of strings)
+        '''
+        return self.stats
+
+    def getRulesVersion(self):
+        '''
+        @return hash of the cleaning rules. (a string)
+        '''
+        return self.rules_version
+
+    def setCleanStreetsDict(self, clean_streets_dict):
+        '''
+        clean_streets_dict: Dictionary mapping dirty street names to clean
+                            street names (a dictionary of strings)
+        '''
+        self.clean_streets_dict = clean_streets_dict
+
+    def createRulesVersion(self):
+        '''
+        Hashes the cleaning rules, so cached audit results are only reused
+        while the rules they were created with are unchanged.
+
+        @return: SHA-1 hex digest of the cleaning rules (a string)
+        '''
+        rules = {'expected' : sorted(self.getExpected()),
+                 'dirty_to_clean_streets' : self.getDirtyToCleanStreets(),
+                 'clean_streets_dict' : self.getCleanStreetsDict(),
+                 'expected_zip' : sorted(self.getExpectedZip()),
+                 'fuzzy' : self.getFuzzyParameters(),
+                 'postcode_boundaries' : None}
+
+        if self.getPostcodeIndex() is not None:
+            boundary_file = self.getPostcodeIndex().getBoundaryFile()
+            rules['postcode_boundaries'] = [os.path.abspath(boundary_file),
+                                            os.path.getsize(boundary_file),
+                                            os.path.getmtime(boundary_file),
+                                            self.getPostcodeIndex().getPostcodeKey(),
+                                            self.getPostcodeIndex().getCellSize()]
+
+        return hashlib.sha1(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def getPosition(self, elem):
+        '''
+        Get GPS (lat, lon) position of XML tag element, if it has one.
+
+        elem: XML tag element object (a object)
+
+        @return: [lat, lon] position, or None if not a located node
+                 (a list of floats)
+        '''
+        try:
+            return [float(elem.attrib['lat']), float(elem.attrib['lon'])]
+        except (KeyError, ValueError):
+            return None
+
     def auditStreetType(self, street_types, street_name):
         '''
         Audits street type by checking if the street type is in the list 
@@ -352,22 +517,67 @@ class CleanStreets(object):
             if street_type not in self.getExpected():
                 street_types[street_type].add(street_name)
 
-    def auditZipType(self, zip_types, zip_name):
+    def auditZipType(self, zip_types, zip_name, pos=None, located=None):
         '''
-        Audits zip code type by checking if the zip type is in the list 
+        Audits zip code type by checking if the zip type is in the list
         of expected zip type values.
 
-        The string of zip_name is the value set to the zip_type key 
+        The string of zip_name is the value set to the zip_type key
         in zip_types defaultdict.
 
-        zip_types: Zip type is a dictionary set, which is mutated within 
-                      the function, passed from audit function. 
+        When a postcode index is set and the tag element has a GPS position,
+        the zip code is also checked against the postcode boundary the
+        position falls in, and a differing postcode is added to the set as a
+        suggestion for review.
+
+        zip_types: Zip type is a dictionary set, which is mutated within
+                      the function, passed from audit function.
                       (a string defaultdict set of strings)
-                      
+
+        zip_name: Zip name string value found in tag attribute. (a string)
+
+        pos: GPS [lat, lon] position of the tag element (a list of floats)
+
+        located: Postcode boundary the position was already found in, by
+                 RawTagScanner, skips the postcode index lookup (a string)
+        '''
+        clean_zip, suggested_zip = self.cleanZip(zip_name, pos, located)
+
+        if clean_zip != zip_name:
+            zip_types[zip_name].add(clean_zip)
+        if suggested_zip is not None:
+            zip_types[zip_name].add(suggested_zip)
+
+    def cleanZip(self, zip_name, pos=None, located=None):
+        '''
+        Finds the clean value of a zip code, the zip code if it is expected,
+        else 'NaN', and a suggested postcode, the postcode boundary the tag
+        element's GPS position falls in when a postcode index is set.
+
+        The zip code is never replaced by the suggested postcode, postcode
+        (ZCTA) boundaries only approximate USPS zip codes, so a valid zip
+        code near a boundary can fall in the neighbouring boundary.
+
         zip_name: Zip name string value found in tag attribute. (a string)
+
+        pos: GPS [lat, lon] position of the tag element (a list of floats)
+
+        located: Postcode boundary the position was already found in, by
+                 RawTagScanner, skips the postcode index lookup (a string)
+
+        @return: Clean zip code, and the suggested postcode or None if it is
+                 not found or is the zip code (a tuple of strings)
         '''
+        if located is None and self.getPostcodeIndex() is not None and pos is not None:
+            located = self.getPostcodeIndex().findPostcode(pos[0], pos[1])
+
+        clean_zip = zip_name
         if zip_name not in self.getExpectedZip():
-            zip_types[zip_name].add('NaN')
+            clean_zip = 'NaN'
+        if located == zip_name:
+            located = None
+
+        return (clean_zip, located)
                 
     def isStreetName(self, elem):
         '''
@@ -389,7 +599,7 @@ class CleanStreets(object):
         '''
         return (elem.attrib['k'] == 'addr:postcode')
         
-    def audit(self, audit_file):
+    def audit(self, audit_file, cache=None):
         '''
         Iterates over XML tag elements in order to find all of the addresses 
         of type street.
@@ -397,26 +607,144 @@ class CleanStreets(object):
         Evaluates the tag 'v' attributes to determine if the street suffixes 
         are within the expected street suffix list.
 
+        Counts every street name found into street_counts, and every element
+        and address tag found into stats.
+
+        audit_file: OSM file to audit (a string)
+
+        cache: Optional audit cache, when audit_file and the cleaning rules
+               are unchanged since the last audit, the cached results are
+               returned without parsing audit_file (an AuditCache object)
+
         @return: Defaultdict of unexpected street suffixes as keys, 
                  the full street names as values. (a defaultdict of strings)
         '''
+        if cache is not None:
+            cached = cache.load(audit_file, self.getRulesVersion(), 'audit')
+            if cached is not None:
+                return self.loadAudit(cached)
+
         with open(audit_file, 'r') as f:
             street_types = defaultdict(set)
             zip_types = defaultdict(set)
+            self.street_counts = Counter()
+            self.stats = Counter()
             f.seek(0)
 
-            for event, elem in ET.iterparse(f, events=('start',)):
+            # Audit each element once it is fully parsed, as its tags are
+            # not all parsed yet at the start event
+            context = iter(ET.iterparse(f, events=('start', 'end')))
+            _, root = next(context)
+
+            for event, elem in context:
+                if event != 'end' or elem.tag not in ('node', 'way', 'relation'):
+                    continue
+                self.stats[elem.tag] += 1
                 if elem.tag == 'node' or elem.tag == 'way':
+                    pos = self.getPosition(elem)
                     for tag in elem.iter('tag'):
                         if self.isStreetName(tag):
                             self.auditStreetType(street_types, tag.attrib['v'])
+                            self.street_counts[tag.attrib['v']] += 1
+                            self.stats['addr:street'] += 1
                         if self.isZipCode(tag):
-                            self.auditZipType(zip_types, tag.attrib['v'])
-                elem.clear()           
+                            self.auditZipType(zip_types, tag.attrib['v'], pos)
+                            self.stats['addr:postcode'] += 1
+                root.clear()
+        street_types = self.sortStreets(street_types)
+
+        if cache is not None:
+            cache.save(audit_file, self.getRulesVersion(), 'audit',
+                       self.dumpAudit(street_types, zip_types))
+
+        return [street_types, zip_types]
+
+
+    def auditRaw(self, audit_file, processes=1, cache=None):
+        '''
+        Audit fast path, finds the same unexpected street types and zip
+        types as self.audit(), by scanning audit_file for street and postcode
+        tags with RawTagScanner instead of parsing every XML element.
+
+        Counts every street name found into street_counts, and every element
+        and address tag found into stats.
+
+        audit_file: OSM file to audit (a string)
+
+        processes: Number of processes audit_file is split across
+                   (a non-zero, positive integer)
+
+        cache: Optional audit cache, shared with self.audit()
+               (an AuditCache object)
+
+        @return: Defaultdict of unexpected street suffixes as keys,
+                 the full street names as values. (a defaultdict of strings)
+        '''
+        if cache is not None:
+            cached = cache.load(audit_file, self.getRulesVersion(), 'audit')
+            if cached is not None:
+                return self.loadAudit(cached)
+
+        scanner = RawTagScanner(audit_file, processes, self.getPostcodeIndex())
+        streets, zips, self.stats = scanner.scan()
+        street_types = defaultdict(set)
+        zip_types = defaultdict(set)
+        self.street_counts = streets
+
+        # Each distinct value is only audited once
+        for street in streets:
+            self.auditStreetType(street_types, street)
+        for zip_name, located in zips:
+            self.auditZipType(zip_types, zip_name, located=located)
         street_types = self.sortStreets(street_types)
 
+        if cache is not None:
+            cache.save(audit_file, self.getRulesVersion(), 'audit',
+                       self.dumpAudit(street_types, zip_types))
+
         return [street_types, zip_types]
 
+
+    def dumpAudit(self, street_types, zip_types):
+        '''
+        Converts audit results into JSON serializable form.
+
+        street_types: Unexpected street suffixes as keys, the full street
+                      names as values (a dictionary of sets)
+
+        zip_types: Unexpected zip codes as keys, the suggested zip codes as
+                   values (a defaultdict of sets)
+
+        @return: Audit results, street counts and stats (a dictionary)
+        '''
+        return {'street_types' : dict((k, sorted(v)) for k, v in street_types.items()),
+                'zip_types' : dict((k, sorted(v)) for k, v in zip_types.items()),
+                'street_counts' : dict(self.getStreetCounts()),
+                'stats' : dict(self.getStats())}
+
+
+    def loadAudit(self, cached):
+        '''
+        Restores audit results saved by self.dumpAudit(), sets street_counts
+        and stats.
+
+        cached: Audit results, street counts and stats (a dictionary)
+
+        @return: Sorted unexpected street types and unexpected zip types, as
+                 returned by self.audit() (a list)
+        '''
+        street_types = defaultdict(set)
+        zip_types = defaultdict(set)
+
+        for k, v in cached['street_types'].items():
+            street_types[k] = set(v)
+        for k, v in cached['zip_types'].items():
+            zip_types[k] = set(v)
+        self.street_counts = Counter(cached['street_counts'])
+        self.stats = Counter(cached['stats'])
+
+        return [self.sortStreets(street_types), zip_types]
+
         
     def sortStreets(self, unsorted_streets):
         '''
@@ -477,6 +805,68 @@ class CleanStreets(object):
 
         return self.clean_streets_dict
 
+
+    def fuzzyClean(self, street_counts):
+        '''
+        Get all street names found by self.audit() and replace misspelled
+        street names with the canonical spelling of the street name.
+
+        Builds a canonical street name index from the dominant spellings of
+        the street names, after they are cleaned by clean_streets_dict and only if their
+        street suffix is expected. Every street name, or its clean value when
+        already mapped, is then matched against the index.
+
+        Should be called after self.clean(), so suffixes are fixed before
+        street names are matched.
+
+        A match is only replaced when its confidence is at least
+        min_confidence and the street name body is at least min_body_length
+        long, other matches are kept in self.suggestions for review.
+
+        Uses the min_count, max_distance, min_confidence, dominance_ratio and
+        min_body_length given to the instance, so they are part of the rules
+        version.
+
+        street_counts: Number of times each street name is found
+                       (a Counter of strings)
+
+        @return: Clean sorted defaultdict of street names with correct
+                 spellings (a defaultdict of strings)
+        '''
+        canonical_counts = Counter()
+
+        for street, count in street_counts.items():
+            clean_street = self.clean_streets_dict.get(street, street).strip()
+            m = self.getStreetTypeRegex().search(clean_street)
+            if m and m.group() in self.getExpected():
+                canonical_counts[clean_street] += count
+
+        fuzzy = self.getFuzzyParameters()
+        self.street_index = StreetIndex(canonical_counts, fuzzy['min_count'],
+                                        fuzzy['max_distance'], fuzzy['dominance_ratio'],
+                                        self.getExpected())
+        self.suggestions = {}
+
+        for street in street_counts:
+            clean_street = self.clean_streets_dict.get(street, street).strip()
+            if clean_street == 'NaN':
+                continue
+
+            canonical, confidence = self.street_index.lookup(clean_street)
+
+            if canonical is None or canonical == street:
+                continue
+
+            # Save each misspelled street as [key] to canonical
+            # street as [value] in clean_streets_dict
+            body = self.street_index.getBody(clean_street)
+            if confidence >= fuzzy['min_confidence'] and len(body) >= fuzzy['min_body_length']:
+                self.clean_streets_dict[street] = canonical
+            elif canonical != clean_street:
+                self.suggestions[street] = (canonical, confidence)
+
+        return self.clean_streets_dict
+
         
     def writeClean(self, cleaned_streets):
         '''
@@ -501,6 +891,8 @@ class CleanStreets(object):
                 # Begin processing when the end of the element is reached
                 # Include all elements, except 'osm', for processing (so that your files are identical)
                 if event == 'end' and (elem.tag in ['node', 'way', 'relation', 'bounds','meta','note'] ):
+                    pos = self.getPosition(elem)
+                    suggested_zip = None
                     for tag in elem.iter('tag'):
                         # Check if tag is a street name tag, set street name to street
                             if self.isStreetName(tag):
@@ -509,11 +901,15 @@ class CleanStreets(object):
                                 # dirty street with clean street value
                                 if street in cleaned_streets.keys(): 
                                     tag.attrib['v'] = cleaned_streets[street]
-                        # Check if tag is a zip code tag, set zip code to 'NaN' if not valid
+                        # Check if tag is a zip code tag, set zip code to 'NaN' if not
+                        # valid, and keep the postcode boundary the node is in if it differs
                             if self.isZipCode(tag):
-                                zip_code = tag.attrib['v']
-                                if zip_code not in self.getExpectedZip():
-                                    tag.attrib['v'] = 'NaN'
+                                tag.attrib['v'], suggested_zip = self.cleanZip(tag.attrib['v'], pos)
+                    # The suggested postcode is written next to the zip code, shaped
+                    # into 'address.postcode_suggested', for review
+                    if suggested_zip is not None:
+                        ET.SubElement(elem, 'tag', {'k' : 'addr:postcode_suggested',
+                                                    'v' : suggested_zip})
                     # Move the write function inside the condition, so that it only writes
                     # tags that you specify (i.e. everything apart from the root <osm> element)
                     output.write(ET.tostring(elem, encoding='utf-8'))
@@ -521,125 +917,781 @@ class CleanStreets(object):
             output.write('</osm>')
             osm_file.close()
 
-            
-class JsonFile(object):
-    def __init__(self, output_file):
+
+class PostcodeIndex(object):
+    '''
+    Postcode boundary index of OSM File
+    Finds the postcode (ZCTA) boundary polygon a GPS position falls in
+    '''
+    def __init__(self, boundary_file, postcode_key='ZCTA5CE10', cell_size=0.01):
         '''
-        Initialize a JSON File instance, saves all parameters as attributes 
-        of the instance. Takes in an XML file and returns a JSON file      
-        
-        lower: Regex created to find lowercase characters for 
-               tag elements (a regex)
-              
-        lower_colon: Regex created to find lowercase characters for 
-                     tag elements when a colon is included (a regex)
-                     
-        problemchars: Regex created to find special characters for 
-                      tags and tag elements (a regex)
-                        
-        created_tags: Tag element names, which are deemed as acceptable for
-                      adding information (a list of strings)
-                  
-        output_file: XML OSM output file, created in given output_file 
-                     path (a string)  
+        Initialize a Postcode Index instance, saves all parameters as
+        attributes of the instance. Loads all postcode boundary polygons
+        from boundary_file into a grid index.
+
+        boundary_file: GeoJSON FeatureCollection of postcode boundary
+                       Polygons and MultiPolygons, such as a ZCTA
+                       shapefile converted to GeoJSON (a string)
+
+        postcode_key: Feature property holding the postcode (a string)
+
+        cell_size: Width and height of each grid cell, in degrees
+                   (a positive float)
+
+        polygons: Postcode, bounding box and row banded edges of each
+                  loaded polygon (a list of tuples)
+
+        grid: Grid cells as keys, indexes of polygons whose bounding box
+              overlaps the cell as values (a defaultdict of lists)
         '''
-        self.lower = re.compile(r'^([a-z]|_)*$')
-        self.lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
-        self.problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
-        self.created_tags = [ 'version', 'changeset', 'timestamp', 'user', 'uid']
-        self.output_file = output_file
+        self.boundary_file = boundary_file
+        self.postcode_key = postcode_key
+        self.cell_size = cell_size
+        self.polygons = []
+        self.grid = defaultdict(list)
+        self.loadBoundaries()
 
-    
-    def getElement(self, file_in, tags=('node', 'way', 'relation')):
+
+    def getBoundaryFile(self):
         '''
-        XML tag element generator
-        
-        tags: tag elements to search for in OSM file (a tuple of strings)
-        
-        @yield element if it is the right type of tag
+        @return boundary file name and/or directory. (a string)
+        '''
+        return self.boundary_file
 
-        Reference:
-        http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
+
+    def getPostcodeKey(self):
         '''
-        context = iter(ET.iterparse(file_in, events=('start', 'end')))
-        _, root = next(context)
-        
-        for event, elem in context:
-            if event == 'end' and elem.tag in tags:
-                yield elem
-                root.clear()    
-        
-    def shapeElement(self, element):
+        @return feature property holding the postcode. (a string)
         '''
-        Takes in XML element, shapes it into JSON node as dictionary, returns shaped element.
-        
-        element: XML ElementTree element, which is shaped into JSON node (an ET object)
-        
-        @return: node for JSON file creation (a dictionary)
+        return self.postcode_key
+
+
+    def getCellSize(self):
         '''
-        node = {}
-        address = {}
-        created = {}
-        node_refs = []
-        pos = []
-        
-        if element.tag == 'node' or element.tag == 'way' :
-            node['type'] = element.tag
-    
-            # Get and store GPS (lat, lon) cooridinates
-            if 'lat' in element.attrib.keys() and 'lon' in element.attrib.keys():
-                try:
-                    lat = float(element.attrib['lat'])
-                    lon = float(element.attrib['lon'])
-                    pos.insert(0,lat)
-                    pos.insert(1,lon)
-                except:
-                    pass
-            
-            # Get and set {tag : attrib} into dict    
-            for k, m in element.attrib.items():
-                if k not in pos:
-                    if k in self.created_tags:
-                        created[k] = m
-                    else:
-                        node[k] = m
-                      
-            # Get and set node type into node dict
-            if created:
-                node['created'] = created
-            if pos:
-                node['pos'] = pos
-            if address:
-                node['address'] = address
-            if node_refs:
-                node['node_refs'] = node_refs
-            if 'lon' in node.keys():
-                node.pop('lon')
-            if 'lat' in node.keys():
-                node.pop('lat')
-            
-            # Iterate over subtags in element, set attribs when valid
-            for child in element:
-                if child.tag == 'nd':
-                    try:
-                        node['node_refs'].append(child.attrib['ref'])
-                    except:
-                        node['node_refs'] = []
-                        node['node_refs'].append(child.attrib['ref'])
-                elif child.tag == 'tag':
-                    # Clean and set 'addr:' attrib
-                    if self.problemchars.search(child.attrib['k']):
-                        pass
-                    elif child.attrib['k'].startswith('addr:'):
-                        key = re.sub('addr:', '', child.attrib['k']).strip()
-                        if self.lower_colon.match(key):
-                            break
-                        else:
-                            try:
+        @return grid cell size in degrees. (a positive float)
+        '''
+        return self.cell_size
+
+
+    def getCell(self, lat, lon):
+        '''
+        lat: GPS latitude (a float)
+
+        lon: GPS longitude (a float)
+
+        @return: Grid cell column and row containing the position
+                 (a tuple of ints)
+        '''
+        return (int(math.floor(lon / self.cell_size)),
+                int(math.floor(lat / self.cell_size)))
+
+
+    def loadBoundaries(self):
+        '''
+        Reads every Polygon and MultiPolygon feature of the boundary file
+        and adds it to the grid index.
+        '''
+        with codecs.open(self.getBoundaryFile(), 'r', encoding='utf-8') as f:
+            features = json.load(f)['features']
+
+        for feature in features:
+            geometry = feature.get('geometry') or {}
+            postcode = str(feature['properties'][self.getPostcodeKey()])
+
+            if geometry.get('type') == 'Polygon':
+                self.addPolygon(postcode, geometry['coordinates'])
+            elif geometry.get('type') == 'MultiPolygon':
+                for rings in geometry['coordinates']:
+                    self.addPolygon(postcode, rings)
+
+
+    def addPolygon(self, postcode, rings):
+        '''
+        Adds a polygon to the grid index.
+
+        Every edge of every ring is stored in each grid row it spans, so a
+        point lookup only ray casts against the edges of a single row. Holes
+        are handled by the even-odd rule, as their edges are stored with the
+        outer ring edges.
+
+        postcode: Postcode of the polygon (a string)
+
+        rings: GeoJSON polygon coordinates, outer ring followed by holes,
+               each a list of [lon, lat] points (a list of lists)
+        '''
+        bands = defaultdict(list)
+        outer = rings[0]
+        min_lon = min(p[0] for p in outer)
+        max_lon = max(p[0] for p in outer)
+        min_lat = min(p[1] for p in outer)
+        max_lat = max(p[1] for p in outer)
+
+        for ring in rings:
+            for i in range(len(ring) - 1):
+                x1, y1 = ring[i][0], ring[i][1]
+                x2, y2 = ring[i + 1][0], ring[i + 1][1]
+                first_row = self.getCell(min(y1, y2), 0)[1]
+                last_row = self.getCell(max(y1, y2), 0)[1]
+                for row in range(first_row, last_row + 1):
+                    bands[row].append((x1, y1, x2, y2))
+
+        index = len(self.polygons)
+        self.polygons.append((postcode, (min_lon, min_lat, max_lon, max_lat), dict(bands)))
+
+        first_col, first_row = self.getCell(min_lat, min_lon)
+        last_col, last_row = self.getCell(max_lat, max_lon)
+        for col in range(first_col, last_col + 1):
+            for row in range(first_row, last_row + 1):
+                self.grid[(col, row)].append(index)
+
+
+    def findPostcode(self, lat, lon):
+        '''
+        Finds the postcode boundary a GPS position falls in.
+
+        lat: GPS latitude (a float)
+
+        lon: GPS longitude (a float)
+
+        @return: Postcode of the boundary containing the position, None if
+                 the position is outside every boundary (a string)
+        '''
+        cell = self.getCell(lat, lon)
+
+        for index in self.grid.get(cell, ()):
+            postcode, bbox, bands = self.polygons[index]
+            if not (bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]):
+                continue
+
+            # Ray cast towards +lon, counting edge crossings
+            inside = False
+            for x1, y1, x2, y2 in bands.get(cell[1], ()):
+                if (y1 > lat) != (y2 > lat):
+                    if lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                        inside = not inside
+            if inside:
+                return postcode
+
+        return None
+
+
+class StreetIndex(object):
+    '''
+    Canonical street name index of OSM File
+    Matches misspelled street names to canonical street names with
+    SymSpell style deletes
+    '''
+    def __init__(self, street_counts, min_count=2, max_distance=2, dominance_ratio=10.0,
+                 street_types=()):
+        '''
+        Initialize a Street Index instance, saves all parameters as attributes
+        of the instance. Admits the dominant spellings of the street names as
+        canonical, and builds the delete index of every canonical street name.
+
+        Street names are walked from most to least frequent. A street name
+        close to an already canonical street name found at least
+        dominance_ratio times as often is a misspelling of it, even when the
+        misspelling repeats, and is not admitted.
+
+        street_counts: Number of times each clean street name is found
+                       (a Counter of strings)
+
+        min_count: Minimum number of times a street name must be found to be
+                   canonical (a positive integer)
+
+        max_distance: Maximum edit distance between a street name and its
+                      canonical street name (a positive integer)
+
+        dominance_ratio: Minimum ratio of the canonical street name count to
+                         a street name count for the street name to be
+                         matched to it, so two streets found about as often,
+                         such as 'Bean Street' and 'Dean Street', are never
+                         matched (a float greater than 1)
+
+        street_types: Street type words which must match exactly, such as
+                      'Street' and 'Avenue' (a list of strings)
+
+        directions: Directional words which must match exactly, so
+                    'West 8th Street' never matches 'East 8th Street'
+                    (a list of strings)
+
+        token_re: Regex created to find the tokens of a street name which must
+                  match exactly, numbers and single letters such as
+                  '14th' or the 'J' of 'Avenue J', directions and street
+                  types (a regex)
+
+        spellings: Lowercase street names as keys, most frequent spelling of
+                   the street name as values (a dictionary of strings)
+
+        canonical: Lowercase canonical street names as keys, their most
+                   frequent spelling as values (a dictionary of strings)
+
+        counts: Lowercase street names as keys, number of times the street
+                name is found as values (a dictionary of integers)
+
+        deletes: Street names with up to max_distance characters deleted as
+                 keys, lowercase canonical street names as values
+                 (a defaultdict of lists)
+
+        matches: Previous lookups, as the same street names are looked up
+                 many times, including the misspellings found while
+                 admitting canonical street names (a dictionary of tuples)
+        '''
+        self.min_count = min_count
+        self.max_distance = max_distance
+        self.dominance_ratio = dominance_ratio
+        self.directions = ['north', 'south', 'east', 'west']
+        exact_words = sorted(set(self.directions + [t.lower() for t in street_types]))
+        self.token_re = re.compile(r'\b(?:\w*\d\w*|\w|{0})\b'.format(
+            '|'.join(re.escape(word) for word in exact_words)))
+        self.spellings = {}
+        self.canonical = {}
+        self.counts = {}
+        self.deletes = defaultdict(list)
+        self.matches = {}
+
+        # Keep the most frequent spelling of each street name
+        for street, count in street_counts.most_common():
+            key = street.lower()
+            if key not in self.spellings:
+                self.spellings[key] = street
+            self.counts[key] = self.counts.get(key, 0) + count
+
+        # Admit the dominant spellings, most frequent first
+        for key in sorted(self.counts, key=lambda k: (-self.counts[k], k)):
+            match = self.findClosest(key)
+            if match[0] is not None:
+                self.matches[key] = match
+            elif self.counts[key] >= self.min_count:
+                self.canonical[key] = self.spellings[key]
+                for delete in self.getDeletes(key):
+                    self.deletes[delete].append(key)
+
+
+    def getMinCount(self):
+        '''
+        @return minimum count of a canonical street name. (a positive integer)
+        '''
+        return self.min_count
+
+
+    def getMaxDistance(self):
+        '''
+        @return maximum edit distance of a match. (a positive integer)
+        '''
+        return self.max_distance
+
+
+    def getDominanceRatio(self):
+        '''
+        @return minimum canonical to street name count ratio of a match.
+                (a float)
+        '''
+        return self.dominance_ratio
+
+
+    def getCanonical(self):
+        '''
+        @return lowercase to canonical street names. (a dictionary of strings)
+        '''
+        return self.canonical
+
+
+    def getDeletes(self, word):
+        '''
+        word: Street name to delete characters from (a string)
+
+        @return: word with up to max_distance characters deleted, including
+                 word itself (a set of strings)
+        '''
+        deletes = set([word])
+        edge = [word]
+
+        for _ in range(self.getMaxDistance()):
+            next_edge = []
+            for w in edge:
+                for i in range(len(w)):
+                    delete = w[:i] + w[i + 1:]
+                    if delete not in deletes:
+                        deletes.add(delete)
+                        next_edge.append(delete)
+            edge = next_edge
+
+        return deletes
+
+
+    def getDistance(self, a, b):
+        '''
+        Optimal string alignment distance (Damerau-Levenshtein with adjacent
+        transpositions) between two street names, stops early once the
+        distance is greater than max_distance.
+
+        a: First street name (a string)
+
+        b: Second street name (a string)
+
+        @return: Edit distance, max_distance + 1 if it is greater than
+                 max_distance (an integer)
+        '''
+        limit = self.getMaxDistance()
+        if abs(len(a) - len(b)) > limit:
+            return limit + 1
+
+        previous = None
+        current = list(range(len(b) + 1))
+
+        for i in range(1, len(a) + 1):
+            before, previous = previous, current
+            current = [i] + [0] * len(b)
+            for j in range(1, len(b) + 1):
+                cost = 0 if a[i - 1] == b[j - 1] else 1
+                current[j] = min(previous[j] + 1,
+                                 current[j - 1] + 1,
+                                 previous[j - 1] + cost)
+                if (i > 1 and j > 1 and a[i - 1] == b[j - 2]
+                        and a[i - 2] == b[j - 1]):
+                    current[j] = min(current[j], before[j - 2] + 1)
+            if min(current) > limit:
+                return limit + 1
+
+        return current[-1]
+
+
+    def getBody(self, street):
+        '''
+        street: Street name (a string)
+
+        @return: Street name without the tokens matched exactly, such as
+                 'flatbush' of 'flatbush avenue' (a string)
+        '''
+        return ' '.join(self.token_re.sub(' ', street.lower()).split())
+
+
+    def findClosest(self, key):
+        '''
+        Finds the canonical street name closest to a lowercase street name.
+
+        Candidates share a delete with the street name, and must have the
+        same numbers, single letters, directions and street types as the
+        street name, so '14th Street' never matches '15th Street' and
+        'West 8th Street' never matches 'East 8th Street'. Candidates must
+        also be found at least dominance_ratio times as often as the street
+        name. The closest candidate wins, ties go to the most frequent
+        candidate.
+
+        Match confidence is measured against the street name bodies, see
+        self.getBody(), so one edit of a short body such as 'Bean' is a
+        low confidence match.
+
+        key: Lowercase street name (a string)
+
+        @return: Canonical street name and match confidence, (None, 0.0) if
+                 no canonical street name is close enough (a tuple)
+        '''
+        match = (None, 0.0)
+        best = None
+        tokens = self.token_re.findall(key)
+        min_candidate_count = self.counts.get(key, 0) * self.getDominanceRatio()
+        candidates = set()
+
+        for delete in self.getDeletes(key):
+            candidates.update(self.deletes.get(delete, ()))
+
+        for candidate in candidates:
+            if self.counts[candidate] < min_candidate_count:
+                continue
+            if self.token_re.findall(candidate) != tokens:
+                continue
+            distance = self.getDistance(key, candidate)
+            if distance > self.getMaxDistance():
+                continue
+            rank = (distance, -self.counts[candidate])
+            if best is None or rank < best:
+                best = rank
+                length = max(len(self.getBody(key)), len(self.getBody(candidate)), distance)
+                confidence = 1.0 - float(distance) / length
+                match = (self.canonical[candidate], confidence)
+
+        return match
+
+
+    def lookup(self, street):
+        '''
+        Finds the canonical street name of a street name, see
+        self.findClosest().
+
+        street: Street name to look up (a string)
+
+        @return: Canonical street name and match confidence, 1.0 for an exact
+                 match, (None, 0.0) if no canonical street name is close
+                 enough (a tuple)
+        '''
+        key = street.lower()
+        if key in self.matches:
+            return self.matches[key]
+
+        if key in self.canonical:
+            match = (self.canonical[key], 1.0)
+        else:
+            match = self.findClosest(key)
+
+        self.matches[key] = match
+        return match
+
+
+class RawTagScanner(object):
+    '''
+    Raw street and postcode tag scanner of OSM File
+    Memory maps the OSM file and scans it with a bytes regex, without
+    building XML elements
+    '''
+    def __init__(self, osm_file, processes=1, postcode_index=None):
+        '''
+        Initialize a Raw Tag Scanner instance, saves all parameters as
+        attributes of the instance.
+
+        osm_file: OSM file to scan (a string)
+
+        processes: Number of processes osm_file is split across, each
+                   scanning one chunk (a non-zero, positive integer)
+
+        postcode_index: Optional postcode boundary index, postcodes of
+                        nodes are located in it while scanning
+                        (a PostcodeIndex object or None)
+        '''
+        self.osm_file = osm_file
+        self.processes = processes
+        self.postcode_index = postcode_index
+
+
+    def getOsmFile(self):
+        '''
+        @return OSM file name and/or directory. (a string)
+        '''
+        return self.osm_file
+
+
+    def getProcesses(self):
+        '''
+        @return number of processes. (a non-zero, positive integer)
+        '''
+        return self.processes
+
+
+    def getChunks(self):
+        '''
+        Splits the OSM file into one byte range per process.
+
+        @return: Scan arguments of each chunk, OSM file, start and end byte
+                 offsets and postcode index (a list of tuples)
+        '''
+        size = os.path.getsize(self.getOsmFile())
+        step = size // self.getProcesses() + 1
+
+        return [(self.getOsmFile(), start, min(start + step, size), self.postcode_index)
+                for start in range(0, size, step)]
+
+
+    def scan(self):
+        '''
+        Scans every chunk of the OSM file, in parallel when processes is
+        more than one, and merges the chunk results.
+
+        @return: Street name counts, postcode and located postcode counts,
+                 and element and address tag counts (a tuple of Counters)
+        '''
+        chunks = self.getChunks()
+
+        if self.getProcesses() > 1 and len(chunks) > 1:
+            pool = multiprocessing.Pool(self.getProcesses())
+            try:
+                results = pool.map(scanChunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [scanChunk(chunk) for chunk in chunks]
+
+        streets = Counter()
+        zips = Counter()
+        stats = Counter()
+
+        for chunk_streets, chunk_zips, chunk_stats in results:
+            streets.update(chunk_streets)
+            zips.update(chunk_zips)
+            stats.update(chunk_stats)
+
+        return streets, zips, stats
+
+
+class AuditCache(object):
+    '''
+    Audit result cache of OSM File
+    Saves audit results on disk, keyed by the input file and cleaning rules
+    '''
+    def __init__(self, cache_dir, format_version=1):
+        '''
+        Initialize a Audit Cache instance, saves all parameters as attributes
+        of the instance. Creates cache_dir if it does not exist.
+
+        cache_dir: Directory the cached results are saved in (a string)
+
+        format_version: Version of the cached results format, bumped when
+                        the audit itself changes, so old results are not
+                        reused (a positive integer)
+
+        fingerprint_file: Input file paths as keys, the size, mtime and
+                          SHA-1 content hash of the input file as values,
+                          saved in cache_dir (a string)
+        '''
+        self.cache_dir = cache_dir
+        self.format_version = format_version
+        self.fingerprint_file = os.path.join(cache_dir, 'fingerprints.json')
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+
+    def getCacheDir(self):
+        '''
+        @return cache directory. (a string)
+        '''
+        return self.cache_dir
+
+
+    def getFormatVersion(self):
+        '''
+        @return cached results format version. (a positive integer)
+        '''
+        return self.format_version
+
+
+    def getFingerprint(self, input_file):
+        '''
+        Fingerprints an input file by its size, mtime and content hash.
+
+        The content hash is only computed when the size or mtime changed
+        since the last fingerprint, so an unchanged file is not read again.
+        A file that was touched but not changed keeps the same content hash.
+
+        input_file: Input file to fingerprint (a string)
+
+        @return: Size, mtime and SHA-1 content hash of input_file
+                 (a dictionary)
+        '''
+        path = os.path.abspath(input_file)
+        size = os.path.getsize(input_file)
+        mtime = os.path.getmtime(input_file)
+
+        fingerprints = {}
+        if os.path.exists(self.fingerprint_file):
+            with open(self.fingerprint_file, 'r') as f:
+                fingerprints = json.load(f)
+
+        fingerprint = fingerprints.get(path)
+        if fingerprint and fingerprint['size'] == size and fingerprint['mtime'] == mtime:
+            return fingerprint
+
+        content_hash = hashlib.sha1()
+        with open(input_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                content_hash.update(chunk)
+
+        fingerprint = {'size' : size,
+                       'mtime' : mtime,
+                       'sha1' : content_hash.hexdigest()}
+        fingerprints[path] = fingerprint
+        writeJsonAtomic(self.fingerprint_file, fingerprints)
+
+        return fingerprint
+
+
+    def getCacheFile(self, input_file, rules_version, name):
+        '''
+        input_file: Input file the results are created from (a string)
+
+        rules_version: Hash of the cleaning rules (a string)
+
+        name: Name of the cached results, such as 'audit' (a string)
+
+        @return: Cache file of the results (a string)
+        '''
+        fingerprint = self.getFingerprint(input_file)
+        key = '{0}:{1}:{2}:{3}:{4}'.format(self.getFormatVersion(),
+                                           fingerprint['size'],
+                                           fingerprint['sha1'],
+                                           rules_version,
+                                           name)
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+        return os.path.join(self.getCacheDir(), '{0}-{1}.json'.format(name, key))
+
+
+    def load(self, input_file, rules_version, name):
+        '''
+        input_file: Input file the results are created from (a string)
+
+        rules_version: Hash of the cleaning rules (a string)
+
+        name: Name of the cached results, such as 'audit' (a string)
+
+        @return: Cached results, None if input_file or the cleaning rules
+                 changed since the results were saved (a dictionary)
+        '''
+        cache_file = self.getCacheFile(input_file, rules_version, name)
+
+        if not os.path.exists(cache_file):
+            return None
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+
+
+    def save(self, input_file, rules_version, name, results):
+        '''
+        input_file: Input file the results are created from (a string)
+
+        rules_version: Hash of the cleaning rules (a string)
+
+        name: Name of the cached results, such as 'audit' (a string)
+
+        results: JSON serializable results to cache (a dictionary)
+        '''
+        writeJsonAtomic(self.getCacheFile(input_file, rules_version, name), results)
+
+
+class JsonFile(object):
+    def __init__(self, output_file):
+        '''
+        Initialize a JSON File instance, saves all parameters as attributes 
+        of the instance. Takes in an XML file and returns a JSON file      
+        
+        lower: Regex created to find lowercase characters for 
+               tag elements (a regex)
+              
+        lower_colon: Regex created to find lowercase characters for 
+                     tag elements when a colon is included (a regex)
+                     
+        problemchars: Regex created to find special characters for 
+                      tags and tag elements (a regex)
+                        
+        created_tags: Tag element names, which are deemed as acceptable for
+                      adding information (a list of strings)
+                  
+        output_file: XML OSM output file, created in given output_file 
+                     path (a string)  
+        '''
+        self.lower = re.compile(r'^([a-z]|_)*$')
+        self.lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
+        self.problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+        self.created_tags = [ 'version', 'changeset', 'timestamp', 'user', 'uid']
+        self.output_file = output_file
+
+    
+    def getElement(self, file_in, tags=('node', 'way', 'relation')):
+        '''
+        XML tag element generator
+        
+        tags: tag elements to search for in OSM file (a tuple of strings)
+        
+        @yield element if it is the right type of tag
+
+        Reference:
+        http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
+        '''
+        context = iter(ET.iterparse(file_in, events=('start', 'end')))
+        _, root = next(context)
+        
+        for event, elem in context:
+            if event == 'end' and elem.tag in tags:
+                yield elem
+                root.clear()    
+        
+    def shapeElement(self, element):
+        '''
+        Takes in XML element, shapes it into JSON node as dictionary, returns shaped element.
+
+        Relation members are set as a list of {type, ref, role} in 'members',
+        and the relation 'type' tag, such as 'multipolygon', is set as
+        'relation_type' so it does not replace the element type.
+        
+        element: XML ElementTree element, which is shaped into JSON node (an ET object)
+        
+        @return: node for JSON file creation (a dictionary)
+        '''
+        node = {}
+        address = {}
+        created = {}
+        node_refs = []
+        pos = []
+        
+        if element.tag == 'node' or element.tag == 'way' or element.tag == 'relation':
+            node['type'] = element.tag
+    
+            # Get and store GPS (lat, lon) cooridinates
+            if 'lat' in element.attrib.keys() and 'lon' in element.attrib.keys():
+                try:
+                    lat = float(element.attrib['lat'])
+                    lon = float(element.attrib['lon'])
+                    pos.insert(0,lat)
+                    pos.insert(1,lon)
+                except:
+                    pass
+            
+            # Get and set {tag : attrib} into dict    
+            for k, m in element.attrib.items():
+                if k not in pos:
+                    if k in self.created_tags:
+                        created[k] = m
+                    else:
+                        node[k] = m
+                      
+            # Get and set node type into node dict
+            if created:
+                node['created'] = created
+            if pos:
+                node['pos'] = pos
+            if address:
+                node['address'] = address
+            if node_refs:
+                node['node_refs'] = node_refs
+            if 'lon' in node.keys():
+                node.pop('lon')
+            if 'lat' in node.keys():
+                node.pop('lat')
+            
+            # Iterate over subtags in element, set attribs when valid
+            for child in element:
+                if child.tag == 'nd':
+                    try:
+                        node['node_refs'].append(child.attrib['ref'])
+                    except:
+                        node['node_refs'] = []
+                        node['node_refs'].append(child.attrib['ref'])
+                elif child.tag == 'member':
+                    member = {'type' : child.attrib['type'],
+                              'ref' : child.attrib['ref'],
+                              'role' : child.attrib.get('role', '')}
+                    try:
+                        node['members'].append(member)
+                    except:
+                        node['members'] = []
+                        node['members'].append(member)
+                elif child.tag == 'tag':
+                    # Clean and set 'addr:' attrib
+                    if self.problemchars.search(child.attrib['k']):
+                        pass
+                    elif child.attrib['k'].startswith('addr:'):
+                        key = re.sub('addr:', '', child.attrib['k']).strip()
+                        if self.lower_colon.match(key):
+                            break
+                        else:
+                            try:
                                 node['address'][key] = child.attrib['v']
                             except:
                                 node['address'] = {}
                                 node['address'][key] = child.attrib['v']
+                    elif element.tag == 'relation' and child.attrib['k'] == 'type':
+                        node['relation_type'] = child.attrib['v']
                     # Set already clean attrib
                     else:
                         node[child.attrib['k']] = child.attrib['v']
@@ -648,45 +1700,1560 @@ class JsonFile(object):
         else:
             return None
 
-            
-    def processMap(self, pretty = False):
+            
+    def processMap(self, pretty = False, checkpoint = None, keep_data = True,
+                   checkpoint_every = 100000, geometry = None, partitioner = None):
+        '''
+        Takes an XML file, maps and creates a JSON file of the same information,
+        struction, and element nodes as the input XML file
+
+        When a checkpoint is given, the number of elements processed and the
+        JSON file byte offset are recorded every checkpoint_every elements.
+        A restarted run truncates the JSON file to the last recorded offset,
+        skips the elements already processed and appends the rest.
+
+        When a geometry store is given, node positions and way coordinates
+        are added to it, and multipolygon and boundary relations are set a
+        GeoJSON 'geometry' assembled from their member ways. OSM files list
+        nodes, then ways, then relations, so this is done in the same pass.
+        The geometry store is cleared unless the run is resumed.
+
+        When a tile partitioner is given, every element is instead set a
+        'tile' key and written to the JSON file of its tile only, and the
+        checkpoint records the tile file sizes.
+        
+        pretty: If pretty, creates a human readable JSON file (a bool)
+
+        checkpoint: Optional pipeline checkpoint (a Checkpoint object)
+
+        keep_data: If keep_data, returns every shaped element, else returns
+                   an empty list so memory stays bounded (a bool)
+
+        checkpoint_every: Number of elements between checkpoints
+                          (a non-zero, positive integer)
+
+        geometry: Optional node and way geometry store, saved with each
+                  checkpoint (a GeometryStore object)
+
+        partitioner: Optional tile partitioner, its tile file sizes are
+                     saved with each checkpoint (a TilePartitioner object)
+        
+        @return: List of JSON dictionary shaped node elements (a list)
+        '''
+        file_in = self.output_file
+        file_out = '{0}.json'.format(file_in)
+        data = []
+        skip = 0
+        mode = 'w'
+        tiles = {}
+
+        if checkpoint is not None:
+            state = checkpoint.getStage('json', file_in)
+            if state and state.get('complete'):
+                return data
+            if state and partitioner is not None:
+                skip = state['elements']
+                tiles = state.get('tiles', {})
+            elif state and os.path.exists(file_out):
+                skip = state['elements']
+                mode = 'a'
+                with open(file_out, 'r+b') as fo:
+                    fo.truncate(state['offset'])
+
+        # Nodes and ways left by an earlier run would be used for relations
+        # of this run, only keep them when resuming
+        if geometry is not None and skip == 0:
+            geometry.clear()
+
+        if partitioner is not None:
+            partitioner.restore(tiles)
+        
+        '''
+        # Create JSON output file, shape and map each XML element
+        with codecs.open(file_out, 'w') as fo:
+            for _, element in ET.iterparse(file_in):
+                el = self.shapeElement(element)
+                if el:
+                    data.append(el)
+                    if pretty:
+                        fo.write(json.dumps(el, indent=2) + '\n')
+                    else:
+                        fo.write(json.dumps(el) + '\n')
+
+        return data
+        '''
+        # Tiled elements are only written to their tile files
+        fo = None
+        if partitioner is None:
+            fo = codecs.open(file_out, mode)
+
+        try:
+            for i, element in enumerate(self.getElement(file_in)):
+                if i < skip:
+                    continue
+                el = self.shapeElement(element)
+                coordinates = None
+                if el and geometry is not None:
+                    coordinates = geometry.addElement(el)
+                if el and keep_data:
+                    data.append(el)
+                if el and partitioner is not None:
+                    partitioner.addElement(el, coordinates)
+                elif el:
+                    if pretty:
+                        fo.write(json.dumps(el, indent = 2) + '\n')
+                    else:
+                        fo.write(json.dumps(el) + '\n')
+
+                if checkpoint is not None and (i + 1) % checkpoint_every == 0:
+                    state = {'elements' : i + 1}
+                    if geometry is not None:
+                        geometry.commit()
+                    if partitioner is not None:
+                        state['tiles'] = partitioner.sync()
+                    else:
+                        fo.flush()
+                        os.fsync(fo.fileno())
+                        state['offset'] = fo.tell()
+                    checkpoint.update('json', file_in, state)
+        finally:
+            if fo is not None:
+                fo.close()
+
+        if geometry is not None:
+            geometry.commit()
+        if partitioner is not None:
+            partitioner.sync()
+        if checkpoint is not None:
+            checkpoint.update('json', file_in, {'complete' : True})
+                        
+        return data
+
+
+class GeometryStore(object):
+    '''
+    Geometry store of OSM File
+    Disk backed node position and way coordinate index, used to assemble
+    relation geometries with bounded memory
+    '''
+    def __init__(self, store_file, batch_size=10000):
+        '''
+        Initialize a Geometry Store instance, saves all parameters as
+        attributes of the instance. Opens or creates the SQLite store file.
+
+        store_file: SQLite file the node positions and way coordinates are
+                    stored in (a string)
+
+        batch_size: Number of node positions buffered in memory before they
+                    are written to the store (a non-zero, positive integer)
+
+        relation_types: Relation types whose geometry is assembled
+                        (a list of strings)
+
+        pending_nodes: Node positions not yet written to the store
+                       (a list of tuples)
+        '''
+        self.store_file = store_file
+        self.batch_size = batch_size
+        self.relation_types = ['multipolygon', 'boundary']
+        self.pending_nodes = []
+        self.db = sqlite3.connect(store_file)
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS nodes '
+                        '(id INTEGER PRIMARY KEY, lat REAL, lon REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS ways '
+                        '(id INTEGER PRIMARY KEY, coordinates TEXT)')
+
+
+    def getStoreFile(self):
+        '''
+        @return store file name and/or directory. (a string)
+        '''
+        return self.store_file
+
+
+    def getRelationTypes(self):
+        '''
+        @return relation types whose geometry is assembled. (a list of strings)
+        '''
+        return self.relation_types
+
+
+    def addElement(self, el):
+        '''
+        Adds a shaped node's position or way's coordinates to the store, or
+        sets a shaped relation's assembled geometry.
+
+        el: Shaped element, from JsonFile.shapeElement() (a dictionary)
+
+        @return: GeoJSON [lon, lat] coordinates of a way, so they can be
+                 passed to self.getCentroid(), else None (a list of lists)
+        '''
+        if el['type'] == 'node' and 'pos' in el:
+            self.addNode(el['id'], el['pos'])
+        elif el['type'] == 'way' and 'node_refs' in el:
+            return self.addWay(el['id'], el['node_refs'])
+        elif el['type'] == 'relation' and el.get('relation_type') in self.getRelationTypes():
+            geometry = self.assemble(el.get('members', []))
+            if geometry:
+                el['geometry'] = geometry
+        return None
+
+
+    def addNode(self, node_id, pos):
+        '''
+        node_id: OSM node id (a string)
+
+        pos: GPS [lat, lon] position of the node (a list of floats)
+        '''
+        self.pending_nodes.append((int(node_id), pos[0], pos[1]))
+
+        if len(self.pending_nodes) >= self.batch_size:
+            self.flushNodes()
+
+
+    def flushNodes(self):
+        '''
+        Writes the buffered node positions to the store.
+        '''
+        if self.pending_nodes:
+            self.db.executemany('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)',
+                                self.pending_nodes)
+            self.pending_nodes = []
+
+
+    def addWay(self, way_id, node_refs):
+        '''
+        Resolves a way's node references to positions, and stores the way's
+        coordinates. Nodes missing from the store, such as nodes outside of
+        the extract, are left out.
+
+        way_id: OSM way id (a string)
+
+        node_refs: OSM node ids of the way, in order (a list of strings)
+
+        @return: GeoJSON [lon, lat] coordinates of the way (a list of lists)
+        '''
+        self.flushNodes()
+        refs = [int(ref) for ref in node_refs]
+        positions = {}
+
+        # Stay below SQLite's limit of host parameters per statement
+        for i in range(0, len(refs), 500):
+            chunk = refs[i:i + 500]
+            query = 'SELECT id, lat, lon FROM nodes WHERE id IN ({0})'.format(
+                ', '.join('?' * len(chunk)))
+            for node_id, lat, lon in self.db.execute(query, chunk):
+                positions[node_id] = [lon, lat]
+
+        coordinates = [positions[ref] for ref in refs if ref in positions]
+        self.db.execute('INSERT OR REPLACE INTO ways VALUES (?, ?)',
+                        (int(way_id), json.dumps(coordinates)))
+        return coordinates
+
+
+    def getWayCoordinates(self, way_id):
+        '''
+        way_id: OSM way id (a string)
+
+        @return: GeoJSON [lon, lat] coordinates of the way, None if the way
+                 is not in the store (a list of lists)
+        '''
+        row = self.db.execute('SELECT coordinates FROM ways WHERE id = ?',
+                              (int(way_id),)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+
+    def getCentroid(self, el, coordinates=None):
+        '''
+        Finds the position of a shaped element, the node position, or the
+        mean of the way coordinates or of the relation outer ring
+        coordinates.
+
+        el: Shaped element, after self.addElement() (a dictionary)
+
+        coordinates: Optional way coordinates returned by self.addElement(),
+                     else they are read from the store (a list of lists)
+
+        @return: GPS [lat, lon] position, None if the element has no
+                 coordinates in the store (a list of floats)
+        '''
+        if el['type'] == 'node':
+            return el.get('pos')
+        elif el['type'] == 'way':
+            if coordinates is None:
+                coordinates = self.getWayCoordinates(el['id'])
+        elif 'geometry' in el:
+            polygons = el['geometry']['coordinates']
+            if el['geometry']['type'] == 'Polygon':
+                polygons = [polygons]
+            coordinates = [point for polygon in polygons for point in polygon[0]]
+
+        if not coordinates:
+            return None
+        return [sum(p[1] for p in coordinates) / len(coordinates),
+                sum(p[0] for p in coordinates) / len(coordinates)]
+
+
+    def assemble(self, members):
+        '''
+        Assembles a multipolygon from the member ways of a relation.
+
+        Member ways are joined into closed rings, 'inner' ways into holes
+        and all other ways into outer rings. Each hole is set to the outer
+        ring it lies in. Rings that cannot be closed, such as rings cut by
+        the extract boundary, are left out.
+
+        members: Relation members, from JsonFile.shapeElement()
+                 (a list of dictionaries)
+
+        @return: GeoJSON Polygon or MultiPolygon geometry, None if no outer
+                 ring could be closed (a dictionary)
+        '''
+        outer_ways = []
+        inner_ways = []
+
+        for member in members:
+            if member['type'] != 'way':
+                continue
+            coordinates = self.getWayCoordinates(member['ref'])
+            if not coordinates:
+                continue
+            if member['role'] == 'inner':
+                inner_ways.append(coordinates)
+            else:
+                outer_ways.append(coordinates)
+
+        polygons = [[ring] for ring in buildRings(outer_ways)]
+        if not polygons:
+            return None
+
+        for ring in buildRings(inner_ways):
+            for polygon in polygons:
+                if pointInRing(ring[0][0], ring[0][1], polygon[0]):
+                    polygon.append(ring)
+                    break
+
+        if len(polygons) == 1:
+            return {'type' : 'Polygon', 'coordinates' : polygons[0]}
+        return {'type' : 'MultiPolygon', 'coordinates' : polygons}
+
+
+    def clear(self):
+        '''
+        Deletes all node positions and way coordinates from the store, called
+        before a run that starts from the first element.
+        '''
+        self.pending_nodes = []
+        self.db.execute('DELETE FROM nodes')
+        self.db.execute('DELETE FROM ways')
+        self.db.commit()
+
+
+    def commit(self):
+        '''
+        Writes all buffered node positions and commits the store, called
+        before each pipeline checkpoint.
+        '''
+        self.flushNodes()
+        self.db.commit()
+
+
+    def close(self):
+        '''
+        Commits and closes the store.
+        '''
+        self.commit()
+        self.db.close()
+
+
+class TilePartitioner(object):
+    '''
+    Spatial tile partitioner of JSON File
+    Sets each shaped element's quadkey tile and writes it to one JSON file
+    per tile
+    '''
+    def __init__(self, output_dir, zoom=14, geometry=None, max_open=256):
+        '''
+        Initialize a Tile Partitioner instance, saves all parameters as
+        attributes of the instance. Creates output_dir if it does not exist.
+
+        output_dir: Directory the tile JSON files are created in (a string)
+
+        zoom: Quadkey zoom level, the quadkey of each tile has zoom digits
+              (a non-zero, positive integer)
+
+        geometry: Optional geometry store, ways and relations are tiled by
+                  their centroid, else only nodes are (a GeometryStore object)
+
+        max_open: Maximum number of tile files open at once
+                  (a non-zero, positive integer)
+
+        unlocated: Tile key of elements without a position (a string)
+
+        open_files: Tile keys as keys, open tile files as values, least
+                    recently written first (an OrderedDict of files)
+        '''
+        self.output_dir = output_dir
+        self.zoom = zoom
+        self.geometry = geometry
+        self.max_open = max_open
+        self.unlocated = 'unlocated'
+        self.open_files = OrderedDict()
+
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+
+    def getOutputDir(self):
+        '''
+        @return tile output directory. (a string)
+        '''
+        return self.output_dir
+
+
+    def getZoom(self):
+        '''
+        @return quadkey zoom level. (a non-zero, positive integer)
+        '''
+        return self.zoom
+
+
+    def getTile(self, el, coordinates=None):
+        '''
+        el: Shaped element (a dictionary)
+
+        coordinates: Optional way coordinates, from GeometryStore.addElement()
+                     (a list of lists)
+
+        @return: Quadkey of the tile the element's position or centroid is
+                 in, the unlocated key if it has neither. An element already
+                 set a 'tile' key, such as a merged document, keeps its tile
+                 (a string)
+        '''
+        if 'tile' in el:
+            return el['tile']
+        if self.geometry is not None:
+            pos = self.geometry.getCentroid(el, coordinates)
+        else:
+            pos = el.get('pos')
+
+        if not pos:
+            return self.unlocated
+        tile_x, tile_y = getTileXY(pos[0], pos[1], self.getZoom())
+        return getQuadKey(tile_x, tile_y, self.getZoom())
+
+
+    def getTileFile(self, tile):
+        '''
+        tile: Tile key (a string)
+
+        @return: JSON file of the tile (a string)
+        '''
+        return os.path.join(self.getOutputDir(), '{0}.json'.format(tile))
+
+
+    def addElement(self, el, coordinates=None):
+        '''
+        Sets the element's 'tile' key and writes it to its tile's JSON file,
+        one document per line. When max_open tile files are open, the least
+        recently written one is closed first.
+
+        el: Shaped element (a dictionary)
+
+        coordinates: Optional way coordinates, from GeometryStore.addElement()
+                     (a list of lists)
+        '''
+        tile = self.getTile(el, coordinates)
+        el['tile'] = tile
+
+        f = self.open_files.pop(tile, None)
+        if f is None:
+            if len(self.open_files) >= self.max_open:
+                self.open_files.popitem(last=False)[1].close()
+            f = open(self.getTileFile(tile), 'a')
+        self.open_files[tile] = f
+
+        f.write(json.dumps(el) + '\n')
+
+
+    def addFile(self, json_file):
+        '''
+        Writes every document of a JSON file, one document per line, to its
+        tile's JSON file, see self.addElement().
+
+        json_file: JSON file to partition (a string)
+
+        @return: Number of documents written (an integer)
+        '''
+        count = 0
+
+        with open(json_file, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    self.addElement(json.loads(line.decode('utf-8')))
+                    count += 1
+
+        return count
+
+
+    def sync(self):
+        '''
+        Closes all open tile files, called before each pipeline checkpoint.
+
+        @return: Tile keys as keys, tile file sizes as values
+                 (a dictionary of integers)
+        '''
+        for f in self.open_files.values():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        self.open_files.clear()
+
+        return dict((tile, os.path.getsize(self.getTileFile(tile)))
+                    for tile in self.getTiles())
+
+
+    def restore(self, tiles):
+        '''
+        Truncates each tile file to the size recorded by self.sync() and
+        removes tile files not recorded, so a restarted run appends to the
+        tile files from the last checkpoint.
+
+        tiles: Tile keys as keys, tile file sizes as values
+               (a dictionary of integers)
+        '''
+        for tile in self.getTiles():
+            if tile in tiles:
+                with open(self.getTileFile(tile), 'r+b') as f:
+                    f.truncate(tiles[tile])
+            else:
+                os.remove(self.getTileFile(tile))
+
+
+    def getTiles(self):
+        '''
+        @return: Tile keys of all tile files, in quadkey order, so nearby
+                 tiles are next to each other (a list of strings)
+        '''
+        return sorted(name[:-len('.json')] for name in os.listdir(self.getOutputDir())
+                      if name.endswith('.json'))
+
+
+    def getBboxTiles(self, min_lat, min_lon, max_lat, max_lon):
+        '''
+        Finds the tiles covering a bounding box, so a bounding box read only
+        touches their tile files, or MongoDB documents with those 'tile' keys.
+
+        min_lat: Southern GPS latitude of the bounding box (a float)
+
+        min_lon: Western GPS longitude of the bounding box (a float)
+
+        max_lat: Northern GPS latitude of the bounding box (a float)
+
+        max_lon: Eastern GPS longitude of the bounding box (a float)
+
+        @return: Quadkeys of the tiles covering the bounding box
+                 (a list of strings)
+        '''
+        min_x, min_y = getTileXY(max_lat, min_lon, self.getZoom())
+        max_x, max_y = getTileXY(min_lat, max_lon, self.getZoom())
+
+        return sorted(getQuadKey(tile_x, tile_y, self.getZoom())
+                      for tile_x in range(min_x, max_x + 1)
+                      for tile_y in range(min_y, max_y + 1))
+
+
+class Checkpoint(object):
+    '''
+    Checkpoint of a pipeline run
+    Records the progress of each pipeline stage, so a restarted run picks up
+    from the last committed point
+    '''
+    def __init__(self, checkpoint_file):
+        '''
+        Initialize a Checkpoint instance, saves all parameters as attributes
+        of the instance. Loads the stages recorded by a previous run.
+
+        checkpoint_file: JSON file the stages are recorded in (a string)
+
+        stages: Stage names as keys, the input file size and mtime and the
+                stage progress as values (a dictionary of dictionaries)
+        '''
+        self.checkpoint_file = checkpoint_file
+        self.stages = {}
+
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file, 'r') as f:
+                self.stages = json.load(f)
+
+
+    def getCheckpointFile(self):
+        '''
+        @return checkpoint file name and/or directory. (a string)
+        '''
+        return self.checkpoint_file
+
+
+    def getInput(self, input_file):
+        '''
+        input_file: Input file of a stage (a string)
+
+        @return: Size and mtime of input_file, None if it does not exist
+                 (a list)
+        '''
+        if not os.path.exists(input_file):
+            return None
+        return [os.path.getsize(input_file), os.path.getmtime(input_file)]
+
+
+    def getStage(self, name, input_file):
+        '''
+        name: Stage name, such as 'json' (a string)
+
+        input_file: Input file of the stage (a string)
+
+        @return: Progress of the stage, None if the stage was not started or
+                 input_file changed since it was recorded (a dictionary)
+        '''
+        stage = self.stages.get(name)
+
+        if stage is None or stage['input'] != self.getInput(input_file):
+            return None
+        return stage['state']
+
+
+    def isComplete(self, name, input_file):
+        '''
+        name: Stage name, such as 'json' (a string)
+
+        input_file: Input file of the stage (a string)
+
+        @return: Bool if the stage completed on the unchanged input_file
+        '''
+        state = self.getStage(name, input_file)
+        return bool(state and state.get('complete'))
+
+
+    def update(self, name, input_file, state):
+        '''
+        Records the progress of a stage and saves the checkpoint file.
+
+        name: Stage name, such as 'json' (a string)
+
+        input_file: Input file of the stage (a string)
+
+        state: Progress of the stage, {'complete' : True} once the stage
+               is done (a dictionary)
+        '''
+        self.stages[name] = {'input' : self.getInput(input_file),
+                             'state' : state}
+        writeJsonAtomic(self.getCheckpointFile(), self.stages)
+
+
+    def clear(self):
+        '''
+        Removes all stages and the checkpoint file, once the run is done.
+        '''
+        self.stages = {}
+        if os.path.exists(self.getCheckpointFile()):
+            os.remove(self.getCheckpointFile())
+
+
+class MongoLoader(object):
+    '''
+    MongoDB loader of JSON File
+    Loads shaped elements in batches with idempotent, version guarded upserts
+    '''
+    def __init__(self, collection, checkpoint=None, batch_size=10000, views=None):
+        '''
+        Initialize a Mongo Loader instance, saves all parameters as
+        attributes of the instance.
+
+        collection: MongoDB collection to load into (a pymongo collection)
+
+        checkpoint: Optional pipeline checkpoint, the JSON file byte offset
+                    and batch id are recorded after each batch is written
+                    (a Checkpoint object)
+
+        batch_size: Number of documents written per batch
+                    (a non-zero, positive integer)
+
+        views: Optional report views, updated with each batch
+               (a ReportViews object)
+
+        stats: Number of documents written, and of stale documents rejected
+               because a higher version is already loaded (a Counter of
+               strings)
+
+        resumed: Bool if a load resumed after a written batch, see
+                 self.isResumed()
+        '''
+        self.collection = collection
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.views = views
+        self.stats = Counter()
+        self.resumed = False
+
+
+    def getCollection(self):
+        '''
+        @return MongoDB collection. (a pymongo collection)
+        '''
+        return self.collection
+
+
+    def getCheckpoint(self):
+        '''
+        @return pipeline checkpoint. (a Checkpoint object or None)
+        '''
+        return self.checkpoint
+
+
+    def getBatchSize(self):
+        '''
+        @return number of documents per batch. (a non-zero, positive integer)
+        '''
+        return self.batch_size
+
+
+    def getViews(self):
+        '''
+        @return report views. (a ReportViews object or None)
+        '''
+        return self.views
+
+
+    def getStats(self):
+        '''
+        @return written and stale document counts. (a Counter of strings)
+        '''
+        return self.stats
+
+
+    def isResumed(self):
+        '''
+        A resumed load writes again the batch written before the crash, and
+        its documents then replace themselves, so the report views are not
+        updated for them. The views should be checked after a resumed load.
+
+        @return: Bool if a load resumed after a written batch
+        '''
+        return self.resumed
+
+
+    def getVersion(self, doc):
+        '''
+        doc: Shaped element (a dictionary)
+
+        @return: OSM version of the element, 0 if it has none (an integer)
+        '''
+        return int(doc.get('created', {}).get('version', 0))
+
+
+    def writeBatch(self, docs):
+        '''
+        Upserts a batch of documents, each replacing the document with the
+        same type and id, so writing a batch twice has no effect. When a
+        type and id appears more than once in the batch, the highest
+        version is written, the last one found for the same version.
+
+        Each document is set an integer 'osm_version' key, its created
+        version, and only replaces a document with a lower or equal
+        'osm_version'. The upsert of a stale document matches no document,
+        and is rejected
+        by the unique type and id index, created by self.load(), instead of
+        inserting a duplicate, so the check and the replace are one atomic
+        write. Rejected documents are counted as stale.
+
+        When report views are set, the documents being replaced are read
+        first, and the views are updated by the difference between the
+        replaced and the new documents that were written.
+
+        docs: Shaped elements (a list of dictionaries)
+        '''
+        latest = OrderedDict()
+        for doc in docs:
+            key = (doc['type'], doc['id'])
+            if key in latest and self.getVersion(latest[key]) != self.getVersion(doc):
+                self.stats['stale'] += 1
+            if key not in latest or self.getVersion(doc) >= self.getVersion(latest[key]):
+                latest[key] = doc
+
+        old_docs = []
+        if self.getViews() is not None:
+            old_docs = self.getViews().findDocuments(latest.keys())
+
+        requests = []
+        for doc in latest.values():
+            doc['osm_version'] = self.getVersion(doc)
+            requests.append(ReplaceOne({'type' : doc['type'],
+                                        'id' : doc['id'],
+                                        'osm_version' : {'$lte' : doc['osm_version']}},
+                                       doc, upsert=True))
+        rejected = set()
+        try:
+            self.getCollection().bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                if error['code'] != 11000:
+                    raise
+                rejected.add(error['index'])
+
+        written = [doc for i, doc in enumerate(latest.values()) if i not in rejected]
+        self.stats['written'] += len(written)
+        self.stats['stale'] += len(rejected)
+
+        if self.getViews() is not None:
+            written_keys = set((doc['type'], doc['id']) for doc in written)
+            old_docs = [doc for doc in old_docs if (doc['type'], doc['id']) in written_keys]
+            self.getViews().update(old_docs, written)
+
+
+    def load(self, json_file):
+        '''
+        Loads a JSON file created by JsonFile.processMap(pretty=False), one
+        document per line, into the collection.
+
+        When a checkpoint is given, a restarted load seeks to the byte offset
+        after the last written batch. A batch written but not yet recorded
+        is written again, which the upserts make harmless to the collection,
+        but not to the report views, see self.isResumed().
+
+        json_file: JSON file to load (a string)
+
+        @return: Number of documents written by this run (an integer)
+        '''
+        stage = 'mongo:{0}'.format(json_file)
+        checkpoint = self.getCheckpoint()
+        offset = 0
+        batch = 0
+        count = 0
+
+        if checkpoint is not None:
+            state = checkpoint.getStage(stage, json_file)
+            if state and state.get('complete'):
+                return count
+            if state:
+                offset = state['offset']
+                batch = state['batch']
+                self.resumed = True
+
+        self.getCollection().create_index([('type', 1), ('id', 1)], unique=True)
+
+        with open(json_file, 'rb') as f:
+            f.seek(offset)
+            docs = []
+
+            while True:
+                line = f.readline()
+                if line.strip():
+                    docs.append(json.loads(line.decode('utf-8')))
+
+                if docs and (len(docs) == self.getBatchSize() or not line):
+                    self.writeBatch(docs)
+                    count += len(docs)
+                    batch += 1
+                    docs = []
+                    if checkpoint is not None:
+                        checkpoint.update(stage, json_file, {'offset' : f.tell(),
+                                                             'batch' : batch})
+                if not line:
+                    break
+
+        if checkpoint is not None:
+            checkpoint.update(stage, json_file, {'complete' : True,
+                                                 'batch' : batch})
+
+        return count
+
+
+class ReportViews(object):
+    '''
+    Materialized report views of MongoDB collection
+    Counters of the report group keys, maintained by MongoLoader as documents
+    are loaded, so reports are indexed reads instead of aggregations
+    '''
+    def __init__(self, collection, views):
+        '''
+        Initialize a Report Views instance, saves all parameters as
+        attributes of the instance. Indexes views by report and count.
+
+        collection: MongoDB collection the reports are on
+                    (a pymongo collection)
+
+        views: MongoDB collection the counters are stored in, one document
+               {_id, report, key, count} per report group key
+               (a pymongo collection)
+
+        reports: Report names as keys, the $match filter and grouped field
+                 of the report as values, as in the __main__ aggregation
+                 pipelines (a dictionary of tuples)
+        '''
+        self.collection = collection
+        self.views = views
+        self.reports = {'type' : ({}, 'type'),
+                        'user' : ({}, 'created.user'),
+                        'amenity' : ({'amenity' : {'$exists' : 1}}, 'amenity'),
+                        'religion' : ({'amenity' : 'place_of_worship'}, 'religion'),
+                        'cuisine' : ({'amenity' : 'restaurant'}, 'cuisine'),
+                        'postcode' : ({'address.postcode' : {'$exists' : 1}}, 'address.postcode')}
+
+        self.views.create_index([('report', 1), ('count', 1)])
+
+
+    def getCollection(self):
+        '''
+        @return MongoDB collection the reports are on. (a pymongo collection)
+        '''
+        return self.collection
+
+
+    def getViews(self):
+        '''
+        @return MongoDB collection of the counters. (a pymongo collection)
+        '''
+        return self.views
+
+
+    def getReports(self):
+        '''
+        @return report names. (a list of strings)
+        '''
+        return sorted(self.reports.keys())
+
+
+    def getPipeline(self, report):
+        '''
+        report: Report name, such as 'amenity' (a string)
+
+        @return: Aggregation pipeline counting the report group keys over
+                 the full collection (a list of dictionaries)
+        '''
+        match, field = self.reports[report]
+
+        return [{'$match' : match},
+                {'$group' : {'_id' : '$' + field,
+                             'count' : {'$sum' : 1}}}]
+
+
+    def getKeys(self, doc):
+        '''
+        Finds the report group keys of a document, the same keys the report
+        aggregation pipelines group it by. A missing grouped field is the
+        None key, as $group groups it under null.
+
+        doc: Shaped element (a dictionary)
+
+        @return: Report name and group key of each report the document
+                 matches (a list of tuples)
+        '''
+        keys = [('type', doc.get('type')),
+                ('user', doc.get('created', {}).get('user'))]
+
+        if 'amenity' in doc:
+            keys.append(('amenity', doc['amenity']))
+        if doc.get('amenity') == 'place_of_worship':
+            keys.append(('religion', doc.get('religion')))
+        if doc.get('amenity') == 'restaurant':
+            keys.append(('cuisine', doc.get('cuisine')))
+        if 'postcode' in doc.get('address', {}):
+            keys.append(('postcode', doc['address']['postcode']))
+
+        return keys
+
+
+    def findDocuments(self, type_ids):
         '''
-        Takes an XML file, maps and creates a JSON file of the same information,
-        struction, and element nodes as the input XML file
-        
-        pretty: If pretty, creates a human readable JSON file (a bool)
-        
-        @return: List of JSON dictionary shaped node elements (a list)
+        Reads the documents about to be replaced, with only the fields the
+        reports group by.
+
+        type_ids: Type and id of each document (a list of tuples)
+
+        @return: Documents found in the collection (a list of dictionaries)
         '''
-        file_in = self.output_file
-        file_out = '{0}.json'.format(file_in)
-        data = []
-        
+        ids = defaultdict(list)
+        for doc_type, doc_id in type_ids:
+            ids[doc_type].append(doc_id)
+
+        fields = {'_id' : 0, 'type' : 1, 'id' : 1, 'created.user' : 1, 'amenity' : 1,
+                  'religion' : 1, 'cuisine' : 1, 'address.postcode' : 1}
+        docs = []
+        for doc_type, doc_ids in ids.items():
+            docs.extend(self.getCollection().find({'type' : doc_type,
+                                                   'id' : {'$in' : doc_ids}}, fields))
+
+        return docs
+
+
+    def update(self, old_docs, new_docs):
         '''
-        # Create JSON output file, shape and map each XML element
-        with codecs.open(file_out, 'w') as fo:
-            for _, element in ET.iterparse(file_in):
-                el = self.shapeElement(element)
-                if el:
-                    data.append(el)
-                    if pretty:
-                        fo.write(json.dumps(el, indent=2) + '\n')
-                    else:
-                        fo.write(json.dumps(el) + '\n')
+        Increments the counters of the new documents' group keys, and
+        decrements those of the documents they replace.
 
-        return data
+        Counters are not updated atomically with the documents, a run that
+        crashes between the two can leave them off, which self.check()
+        finds and self.rebuild() repairs.
+
+        old_docs: Replaced documents (a list of dictionaries)
+
+        new_docs: New documents (a list of dictionaries)
         '''
-        with codecs.open(file_out, 'w') as fo:
-            for i, element in enumerate(self.getElement(file_in)):
-                el = self.shapeElement(element)
-                if el:
-                    data.append(el)
-                    if pretty:
-                        fo.write(json.dumps(el, indent = 2) + '\n')
-                    else:
-                        fo.write(json.dumps(el) + '\n')
-                        
-        return data
+        deltas = Counter()
+        for doc in new_docs:
+            deltas.update(self.getKeys(doc))
+        for doc in old_docs:
+            deltas.subtract(self.getKeys(doc))
+
+        requests = [UpdateOne({'_id' : {'report' : report, 'key' : key}},
+                              {'$inc' : {'count' : delta},
+                               '$set' : {'report' : report, 'key' : key}},
+                              upsert=True)
+                    for (report, key), delta in deltas.items() if delta]
+        if requests:
+            self.getViews().bulk_write(requests, ordered=False)
+
+
+    def top(self, report, limit=0, ascending=False):
+        '''
+        report: Report name, such as 'amenity' (a string)
+
+        limit: Number of group keys returned, 0 for all (an integer)
+
+        ascending: If ascending, the least counted group keys are returned
+                   first (a bool)
+
+        @return: Group keys and counts, in the same {_id, count} form as the
+                 report aggregation pipelines (a list of dictionaries)
+        '''
+        cursor = self.getViews().find({'report' : report, 'count' : {'$gt' : 0}})
+        cursor = cursor.sort('count', 1 if ascending else -1).limit(limit)
+
+        return [{'_id' : view['key'], 'count' : view['count']} for view in cursor]
+
+
+    def count(self, report, key):
+        '''
+        report: Report name, such as 'postcode' (a string)
+
+        key: Group key, such as 'NaN' (a string)
+
+        @return: Group key and count, in the same {_id, count} form as the
+                 report aggregation pipelines (a dictionary)
+        '''
+        view = self.getViews().find_one({'_id' : {'report' : report, 'key' : key}})
+
+        return {'_id' : key, 'count' : view['count'] if view else 0}
+
+
+    def distinct(self, report):
+        '''
+        report: Report name, such as 'user' (a string)
+
+        @return: Number of group keys with a count (an integer)
+        '''
+        return self.getViews().count_documents({'report' : report, 'count' : {'$gt' : 0}})
+
+
+    def rarest(self, report):
+        '''
+        report: Report name, such as 'user' (a string)
+
+        @return: Lowest count of the report's group keys and the number of
+                 group keys with it (a tuple of integers)
+        '''
+        lowest = self.top(report, limit=1, ascending=True)
+        if not lowest:
+            return (0, 0)
+
+        count = lowest[0]['count']
+        return (count, self.getViews().count_documents({'report' : report, 'count' : count}))
+
+
+    def check(self):
+        '''
+        Consistency check of the counters against the report aggregation
+        pipelines run over the full collection.
+
+        @return: Report names as keys, the group keys whose counter differs
+                 as values, as (key, counter, live count) (a dictionary of
+                 lists)
+        '''
+        mismatches = {}
+
+        for report in self.getReports():
+            results = mongoAggregate(self.getCollection().aggregate(self.getPipeline(report)))
+            live = dict((result['_id'], result['count']) for result in results)
+            counted = dict((view['_id'], view['count']) for view in self.top(report))
+
+            diffs = [(key, counted.get(key, 0), live.get(key, 0))
+                     for key in set(live) | set(counted)
+                     if counted.get(key, 0) != live.get(key, 0)]
+            if diffs:
+                mismatches[report] = diffs
+
+        return mismatches
+
+
+    def rebuild(self):
+        '''
+        Recreates all counters from the report aggregation pipelines run
+        over the full collection.
+        '''
+        self.getViews().delete_many({})
+
+        for report in self.getReports():
+            views = [{'_id' : {'report' : report, 'key' : result['_id']},
+                      'report' : report,
+                      'key' : result['_id'],
+                      'count' : result['count']}
+                     for result in mongoAggregate(self.getCollection().aggregate(self.getPipeline(report)))]
+            if views:
+                self.getViews().insert_many(views)
+
+
+class Deduplicator(object):
+    '''
+    Deduplicator of JSON Files
+    Merges the JSON files of overlapping extracts, keeping the highest
+    version of each element and reporting conflicts
+    '''
+    def __init__(self, index_file, max_conflicts=100):
+        '''
+        Initialize a Deduplicator instance, saves all parameters as
+        attributes of the instance. Opens or creates the SQLite index file.
+
+        index_file: SQLite file the kept version of each element is
+                    indexed in (a string)
+
+        max_conflicts: Maximum number of conflicts kept for the report
+                       (a positive integer)
+
+        stats: Number of documents, unique elements, identical duplicates,
+               stale versions and same version conflicts found
+               (a Counter of strings)
+
+        conflicts: First max_conflicts stale versions and conflicts found,
+                   as (type:id, kind, kept version, other version, file)
+                   (a list of tuples)
+        '''
+        self.index_file = index_file
+        self.max_conflicts = max_conflicts
+        self.stats = Counter()
+        self.conflicts = []
+        self.db = sqlite3.connect(index_file)
+        self.db.execute('DROP TABLE IF EXISTS elements')
+        self.db.execute('CREATE TABLE elements (key TEXT PRIMARY KEY, version INTEGER, '
+                        'digest TEXT, file TEXT, emitted INTEGER DEFAULT 0)')
+
+
+    def getIndexFile(self):
+        '''
+        @return index file name and/or directory. (a string)
+        '''
+        return self.index_file
+
+
+    def getStats(self):
+        '''
+        @return document, duplicate and conflict counts. (a Counter of strings)
+        '''
+        return self.stats
+
+
+    def getConflicts(self):
+        '''
+        @return first stale versions and conflicts found. (a list of tuples)
+        '''
+        return self.conflicts
+
+
+    def readDocuments(self, json_files):
+        '''
+        JSON document generator, of JSON files created by
+        JsonFile.processMap(pretty=False), one document per line.
+
+        json_files: JSON files to read (a list of strings)
+
+        @yield file name, element key as type:id, version and content digest
+               of each document, and the document line
+        '''
+        for json_file in json_files:
+            with open(json_file, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    doc = json.loads(line.decode('utf-8'))
+                    doc.pop('tile', None)
+                    key = '{0}:{1}'.format(doc['type'], doc['id'])
+                    version = int(doc.get('created', {}).get('version', 0))
+                    digest = hashlib.sha1(json.dumps(doc, sort_keys=True).encode('utf-8')).hexdigest()
+                    yield json_file, key, version, digest, line
+
+
+    def addConflict(self, key, kind, kept, other, json_file):
+        '''
+        Counts a stale version or conflict, and keeps it for the report.
+
+        key: Element key as type:id (a string)
+
+        kind: 'stale' for a lower version, 'conflict' for the same version
+              with different content (a string)
+
+        kept: Version kept (an integer)
+
+        other: Version not kept (an integer)
+
+        json_file: JSON file of the document found to be a stale version or
+                   conflict (a string)
+        '''
+        self.stats[kind] += 1
+        if len(self.conflicts) < self.max_conflicts:
+            self.conflicts.append((key, kind, kept, other, json_file))
+
+
+    def scan(self, json_files):
+        '''
+        First pass, indexes the highest version of each element, the first
+        one found when the highest version is found more than once.
+
+        Each element is inserted unless already indexed, the primary key
+        lookup of the insert finds elements seen before, and only those are
+        read back.
+
+        json_files: JSON files of the extracts (a list of strings)
+        '''
+        for json_file, key, version, digest, _ in self.readDocuments(json_files):
+            self.stats['documents'] += 1
+
+            inserted = self.db.execute('INSERT OR IGNORE INTO elements (key, version, digest, file) '
+                                       'VALUES (?, ?, ?, ?)',
+                                       (key, version, digest, json_file)).rowcount
+            if inserted:
+                self.stats['unique'] += 1
+                continue
+
+            row = self.db.execute('SELECT version, digest, file FROM elements WHERE key = ?',
+                                  (key,)).fetchone()
+
+            if version > row[0]:
+                # The indexed document is the stale version
+                self.addConflict(key, 'stale', version, row[0], row[2])
+                self.db.execute('UPDATE elements SET version = ?, digest = ?, file = ? WHERE key = ?',
+                                (version, digest, json_file, key))
+            elif version < row[0]:
+                self.addConflict(key, 'stale', row[0], version, json_file)
+            elif digest != row[1]:
+                self.addConflict(key, 'conflict', row[0], version, json_file)
+            else:
+                self.stats['duplicates'] += 1
+
+        self.db.commit()
+
+
+    def merge(self, json_files, file_out):
+        '''
+        Second pass, writes the indexed version of each element once, in the
+        order of json_files. Must follow self.scan() of the same json_files.
+
+        json_files: JSON files of the extracts (a list of strings)
+
+        file_out: Merged JSON output file, one document per line (a string)
+
+        @return: Number of documents written (an integer)
+        '''
+        count = 0
+
+        with open(file_out, 'wb') as fo:
+            for _, key, version, digest, line in self.readDocuments(json_files):
+                row = self.db.execute('SELECT version, digest, emitted FROM elements WHERE key = ?',
+                                      (key,)).fetchone()
+                if row[2] or row[0] != version or row[1] != digest:
+                    continue
+                self.db.execute('UPDATE elements SET emitted = 1 WHERE key = ?', (key,))
+                fo.write(line.rstrip() + b'\n')
+                count += 1
+
+        self.db.commit()
+        return count
+
+
+    def close(self):
+        '''
+        Closes the index.
+        '''
+        self.db.close()
+
+
+def buildRings(lines):
+    '''
+    Joins lines into closed rings, by matching line end points. Lines are
+    reversed when needed. Lines that cannot be closed into a ring are left
+    out.
+
+    lines: Lines of GeoJSON [lon, lat] coordinates (a list of lists)
+
+    @return: Closed rings, first and last coordinates equal, of at least
+             four coordinates (a list of lists)
+    '''
+    lines = [list(line) for line in lines if len(line) >= 2]
+    rings = []
+
+    while lines:
+        ring = lines.pop()
+
+        while ring[0] != ring[-1]:
+            for i, line in enumerate(lines):
+                if line[0] == ring[-1]:
+                    ring.extend(line[1:])
+                elif line[-1] == ring[-1]:
+                    ring.extend(line[-2::-1])
+                else:
+                    continue
+                del lines[i]
+                break
+            else:
+                # No line continues the ring
+                break
+
+        if ring[0] == ring[-1] and len(ring) >= 4:
+            rings.append(ring)
+
+    return rings
+
+
+def pointInRing(lon, lat, ring):
+    '''
+    Ray casting test of whether a point lies inside a ring.
+
+    lon: GPS longitude (a float)
+
+    lat: GPS latitude (a float)
+
+    ring: Closed ring of GeoJSON [lon, lat] coordinates (a list of lists)
+
+    @return: Bool if the point is inside the ring
+    '''
+    inside = False
+
+    for i in range(len(ring) - 1):
+        x1, y1 = ring[i][0], ring[i][1]
+        x2, y2 = ring[i + 1][0], ring[i + 1][1]
+        if (y1 > lat) != (y2 > lat):
+            if lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+
+    return inside
+
+
+RAW_TAG_RE = re.compile(br'<(node|way|relation)\b([^>]*)>'
+                        br'|<tag\s+k=["\']addr:(street|postcode)["\']'
+                        br'\s+v=(?:"([^"]*)"|\'([^\']*)\')')
+RAW_OPEN_RE = re.compile(br'<(?:node|way|relation)\b')
+RAW_LAT_RE = re.compile(br'\blat=["\']([^"\']*)["\']')
+RAW_LON_RE = re.compile(br'\blon=["\']([^"\']*)["\']')
+XML_ENTITY_RE = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|amp|lt|gt|quot|apos);')
+XML_ENTITIES = {'amp' : '&', 'lt' : '<', 'gt' : '>', 'quot' : '"', 'apos' : "'"}
+
+
+def unescapeXml(text):
+    '''
+    Decodes the XML entities and character references of an attribute value.
+
+    text: Attribute value (a string)
+
+    @return: Decoded attribute value (a string)
+    '''
+    def replace(m):
+        entity = m.group(1)
+        if entity.startswith('#x'):
+            return unichr(int(entity[2:], 16))
+        if entity.startswith('#'):
+            return unichr(int(entity[1:]))
+        return XML_ENTITIES[entity]
+
+    return XML_ENTITY_RE.sub(replace, text)
+
+
+def findOpenElement(mm, start, window=65536):
+    '''
+    Finds the last node, way or relation opened before a byte offset of a
+    memory mapped OSM file. Only the window bytes before the offset are
+    searched, the window is widened only if no element opens in it, so the
+    search does not scan back to the start of the file.
+
+    The search reads past the offset by the length of the longest element
+    name, so an element whose opening tag is cut by the offset, such as
+    '<rela|tion', is still found.
+
+    mm: Memory mapped OSM file (a mmap object)
+
+    start: Byte offset to search back from (a non-negative integer)
+
+    window: Number of bytes searched first (a non-zero, positive integer)
+
+    @return: Byte offset of the element, -1 if none is opened before start
+             (an integer)
+    '''
+    high = min(len(mm), start + len(b'<relation'))
+
+    while True:
+        low = max(0, start - window)
+        opened = -1
+        for m in RAW_OPEN_RE.finditer(mm, low, high):
+            if m.start() >= start:
+                break
+            opened = m.start()
+        if opened >= 0 or low == 0:
+            return opened
+        window *= 4
+
+
+def scanChunk(args):
+    '''
+    Scans one byte range of a memory mapped OSM file for street and postcode
+    tags of nodes and ways. Tags belong to the last element opened before
+    them, so the element open before the range is looked up first.
+
+    Module level, so it can be sent to multiprocessing workers.
+
+    args: OSM file, start and end byte offsets and postcode index, from
+          RawTagScanner.getChunks() (a tuple)
+
+    @return: Street name counts, postcode and located postcode counts, and
+             element and address tag counts of tags starting in the range
+             (a tuple of Counters)
+    '''
+    osm_file, start, end, postcode_index = args
+    streets = Counter()
+    zips = Counter()
+    stats = Counter()
+
+    with open(osm_file, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            element = None
+            attrs = b''
+            opened = findOpenElement(mm, start)
+            if opened >= 0:
+                m = RAW_TAG_RE.match(mm, opened)
+                if m and m.group(1):
+                    element, attrs = m.group(1), m.group(2)
+
+            for m in RAW_TAG_RE.finditer(mm, start):
+                if m.start() >= end:
+                    break
+                if m.group(1):
+                    element, attrs = m.group(1), m.group(2)
+                    stats[element.decode('ascii')] += 1
+                    continue
+                if element == b'relation':
+                    continue
+
+                value = m.group(4) if m.group(4) is not None else m.group(5)
+                value = value.decode('utf-8')
+                if '&' in value:
+                    value = unescapeXml(value)
+
+                if m.group(3) == b'street':
+                    streets[value] += 1
+                    stats['addr:street'] += 1
+                else:
+                    located = None
+                    if postcode_index is not None and element == b'node':
+                        lat = RAW_LAT_RE.search(attrs)
+                        lon = RAW_LON_RE.search(attrs)
+                        try:
+                            located = postcode_index.findPostcode(float(lat.group(1)),
+                                                                  float(lon.group(1)))
+                        except (AttributeError, ValueError):
+                            pass
+                    zips[(value, located)] += 1
+                    stats['addr:postcode'] += 1
+        finally:
+            mm.close()
+
+    return streets, zips, stats
+
+
+def getTileXY(lat, lon, zoom):
+    '''
+    Web Mercator tile containing a GPS position.
+
+    lat: GPS latitude (a float)
+
+    lon: GPS longitude (a float)
+
+    zoom: Zoom level (a non-zero, positive integer)
+
+    @return: Tile column and row (a tuple of ints)
+
+    Reference:
+    https://msdn.microsoft.com/en-us/library/bb259689.aspx
+    '''
+    lat = min(max(lat, -85.05112878), 85.05112878)
+    sin_lat = math.sin(lat * math.pi / 180)
+    x = (lon + 180) / 360.0
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    n = 1 << zoom
+
+    return (min(max(int(x * n), 0), n - 1),
+            min(max(int(y * n), 0), n - 1))
+
+
+def getQuadKey(tile_x, tile_y, zoom):
+    '''
+    Quadkey of a tile, the quadkey of a tile starts with the quadkey of every
+    tile containing it, and sorting quadkeys keeps nearby tiles together.
+
+    tile_x: Tile column (an integer)
+
+    tile_y: Tile row (an integer)
+
+    zoom: Zoom level (a non-zero, positive integer)
+
+    @return: Quadkey of zoom digits (a string)
+    '''
+    digits = []
+
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digit = 0
+        if tile_x & mask:
+            digit += 1
+        if tile_y & mask:
+            digit += 2
+        digits.append(str(digit))
+
+    return ''.join(digits)
+
+
+def writeJsonAtomic(file_out, data):
+    '''
+    Writes data to a JSON file, through a temporary file which then replaces
+    file_out, so file_out is never left half written.
+
+    file_out: JSON output file (a string)
+
+    data: JSON serializable data (an object)
+    '''
+    temp_file = '{0}.tmp'.format(file_out)
+
+    with open(temp_file, 'w') as f:
+        json.dump(data, f)
+
+    if hasattr(os, 'replace'):
+        os.replace(temp_file, file_out)
+    else:
+        # Python 2 on Windows cannot rename over an existing file
+        if os.name == 'nt' and os.path.exists(file_out):
+            os.remove(file_out)
+        os.rename(temp_file, file_out)
+
+
 def mongoAggregate(cursor):
     '''
     Takes in pymongo aggregate cursor object, iterates through each element
@@ -710,7 +3277,47 @@ if __name__ == '__main__':
     xml_sample_file = 'sample.osm'  # Sample OSM File output name
     xml_cleaned_file = 'output.osm'
     sample_size = 1
-    
+
+    # Optional postcode (ZCTA) boundaries, as GeoJSON, used to suggest a
+    # postcode from node positions, kept next to the original postcode
+    # https://www.census.gov/geo/maps-data/data/cbf/cbf_zcta.html
+    zip_boundary_file = 'zcta_boundaries.geojson'
+
+    # Audit results and clean mappings are cached here, and reused while the
+    # input file and cleaning rules are unchanged
+    audit_cache_dir = '.audit_cache'
+
+    # Audit by scanning the raw street and postcode tags of the memory mapped
+    # file, split across audit_processes, instead of parsing every element
+    fast_audit = True
+    audit_processes = multiprocessing.cpu_count()
+
+    # Progress of the clean, JSON and MongoDB load stages is recorded here,
+    # so a restarted run picks up from the last committed point
+    checkpoint_file = 'pipeline.checkpoint.json'
+
+    # Node positions and way coordinates are stored here while relation
+    # geometries are assembled, and kept with the checkpoint
+    geometry_file = 'geometry.sqlite'
+
+    # Optionally partition the shaped documents into quadkey tiles, written
+    # to one JSON file per tile in tile_dir and loaded in tile order
+    partition_output = True
+    tile_dir = 'tiles'
+    tile_zoom = 14
+
+    # Optionally check the report views against the aggregation pipelines
+    # over the full collection after loading, one full aggregation per report.
+    # They are always checked after a resumed load
+    check_views = False
+
+    # JSON files of overlapping neighbour extracts, created by this script,
+    # merged with this extract keeping the highest version of each element
+    extract_json_files = []
+    merged_json_file = 'merged.osm.json'
+    merged_tile_dir = 'merged_tiles'
+    dedup_index_file = 'dedup.sqlite'
+
     # Initialize and create OSM original file and sample file
     if sample_size == 1:
         xml_sample_file = xml_original_file
@@ -722,14 +3329,25 @@ if __name__ == '__main__':
     
     # Initialize and clean street type tag attributes
     print('\nInitialzing and getting street type tag attributes...')
-    cleanSt = CleanStreets(xml_sample_file)
+    postcode_index = None
+    if os.path.exists(zip_boundary_file):
+        print('Loading postcode boundaries from ' + zip_boundary_file + '...')
+        postcode_index = PostcodeIndex(zip_boundary_file)
+    cleanSt = CleanStreets(xml_sample_file, postcode_index)
 
     # Audit street tag attributes and store vales in unexpected_street dict
     # returns street type keys with street name values dict
     print('\nPerforming audit on street types...')
-    audit_results = cleanSt.audit(xml_sample_file)
+    audit_cache = AuditCache(audit_cache_dir)
+    if fast_audit:
+        audit_results = cleanSt.auditRaw(xml_sample_file, audit_processes, audit_cache)
+    else:
+        audit_results = cleanSt.audit(xml_sample_file, audit_cache)
     unexpected_streets = audit_results[0]
     unexpected_zips = audit_results[1]
+
+    print('Dataset statistics: ')
+    pprint.pprint(dict(cleanSt.getStats()))
     
     print('There are ' + str(len(unexpected_streets.values())) + ' unique unexpected streets.')
     print('Dictionary of unexpected street name types with street names: ')
@@ -741,7 +3359,22 @@ if __name__ == '__main__':
 
     # Clean street values and store cleaned streets in clean_street_dict
     print('\nCleaning street type values...')
-    clean_streets_dict = cleanSt.clean(unexpected_streets)
+    clean_streets_dict = audit_cache.load(xml_sample_file, cleanSt.getRulesVersion(), 'clean')
+
+    if clean_streets_dict is not None:
+        print('Using cached clean street values.')
+        cleanSt.setCleanStreetsDict(clean_streets_dict)
+    else:
+        clean_streets_dict = cleanSt.clean(unexpected_streets)
+
+        # Match misspelled street names to canonical street names
+        print('\nMatching street names against canonical street names...')
+        clean_streets_dict = cleanSt.fuzzyClean(cleanSt.getStreetCounts())
+        print('There are ' + str(len(cleanSt.getStreetIndex().getCanonical())) + ' canonical street names.')
+        print('Street name matches not replaced, for review: ')
+        pprint.pprint(cleanSt.getSuggestions())
+        audit_cache.save(xml_sample_file, cleanSt.getRulesVersion(), 'clean', clean_streets_dict)
+
     print('There are ' + str(len(cleanSt.getCleanStreetsDict().values())) + ' street names to be replaced.')
     print('Dictionary of dirty street keys and clean street values: ')
     pprint.pprint(clean_streets_dict)
@@ -749,8 +3382,20 @@ if __name__ == '__main__':
     
     # Find and write clean street names to XML file, save updated XML file
     print('\nCreating new output.osm file with cleaned street types...')
-    cleanSt.writeClean(clean_streets_dict)
-    clean_audit_results = cleanSt.audit(xml_sample_file)
+    checkpoint = Checkpoint(checkpoint_file)
+    clean_state = checkpoint.getStage('clean', xml_sample_file)
+
+    if (clean_state and clean_state.get('rules_version') == cleanSt.getRulesVersion()
+            and os.path.exists(xml_cleaned_file)):
+        print('Using output.osm file from previous run.')
+    else:
+        cleanSt.writeClean(clean_streets_dict)
+        checkpoint.update('clean', xml_sample_file, {'complete' : True,
+                                                     'rules_version' : cleanSt.getRulesVersion()})
+    if fast_audit:
+        clean_audit_results = cleanSt.auditRaw(xml_sample_file, audit_processes, audit_cache)
+    else:
+        clean_audit_results = cleanSt.audit(xml_sample_file, audit_cache)
     clean_unexpected_streets = clean_audit_results[0]
     
     print('There are ' + str(len(clean_unexpected_streets.values())) + ' unique unexpected streets.')
@@ -764,111 +3409,158 @@ if __name__ == '__main__':
     # Initialize and create JSON file from cleaned XML output.osm file
     print('\nCreating new JSON file from cleaned XML file...')
     js = JsonFile(xml_cleaned_file)
-    data = js.processMap()
-    print('\nDeleting XML cleaned file...')
-    os.remove(xml_cleaned_file)
+    geometry = GeometryStore(geometry_file)
+    partitioner = None
+    if partition_output:
+        partitioner = TilePartitioner(tile_dir, tile_zoom, geometry)
+    js.processMap(checkpoint=checkpoint, keep_data=False, geometry=geometry,
+                  partitioner=partitioner)
+    geometry.close()
 
-    # Initialize and create MongoDB database from JSON document list 'data'
+    # Initialize and create MongoDB database from cleaned JSON file
     print('\nCreating new MongoDB database \'brooklyn\' from cleaned JSON file...')
     client = MongoClient('mongodb://localhost:27017')
     db = client.osm_results
-    db.brooklyn.insert_many(data, bypass_document_validation=True)
-    del data[:]
+    views = ReportViews(db.brooklyn, db.brooklyn_reports)
+    loader = MongoLoader(db.brooklyn, checkpoint, views=views)
+    if partition_output:
+        db.brooklyn.create_index('tile')
+
+    # The merge is skipped while its recorded inputs and merged file are
+    # unchanged, so the load checkpoints of the merged files stay valid
+    if extract_json_files:
+        if partition_output:
+            json_files = [partitioner.getTileFile(tile) for tile in partitioner.getTiles()]
+        else:
+            json_files = ['{0}.json'.format(xml_cleaned_file)]
+        json_files += extract_json_files
+        merge_inputs = [[json_file, checkpoint.getInput(json_file)] for json_file in json_files]
+        merge_state = checkpoint.getStage('merge', merged_json_file)
+        merged_partitioner = None
+        if partition_output:
+            merged_partitioner = TilePartitioner(merged_tile_dir, tile_zoom)
+
+        if merge_state and merge_state.get('inputs') == merge_inputs:
+            print('\nOverlapping extracts already merged, skipping merge...')
+        else:
+            print('\nMerging overlapping extracts...')
+            dedup = Deduplicator(dedup_index_file)
+            dedup.scan(json_files)
+            dedup.merge(json_files, merged_json_file)
+            dedup.close()
+            print('Merge statistics: ')
+            pprint.pprint(dict(dedup.getStats()))
+            print('Stale versions and conflicts found: ')
+            pprint.pprint(dedup.getConflicts())
+            os.remove(dedup_index_file)
+
+            # Merged documents keep the tile they were set, so the merged
+            # file is loaded in tile order too
+            if merged_partitioner is not None:
+                merged_partitioner.restore({})
+                merged_partitioner.addFile(merged_json_file)
+                merged_partitioner.sync()
+            checkpoint.update('merge', merged_json_file, {'complete' : True,
+                                                          'inputs' : merge_inputs})
+
+        if merged_partitioner is not None:
+            load_files = [merged_partitioner.getTileFile(tile)
+                          for tile in merged_partitioner.getTiles()]
+        else:
+            load_files = [merged_json_file]
+    elif partition_output:
+        load_files = [partitioner.getTileFile(tile) for tile in partitioner.getTiles()]
+    else:
+        load_files = ['{0}.json'.format(xml_cleaned_file)]
+
+    for json_file in load_files:
+        loader.load(json_file)
+    print('Load statistics, stale versions rejected by the upserts: ')
+    pprint.pprint(dict(loader.getStats()))
+
+    # Only remove the cleaned XML file once the load has succeeded
+    print('\nDeleting XML cleaned file...')
+    os.remove(xml_cleaned_file)
+    os.remove(geometry_file)
+    checkpoint.clear()
     
     # Run and output MongoDB querires and results
     print('\nRunning MongoDB queries...')
     
     print('\nTotal number of documents: ')
-    print('db.brooklyn.find().count()')
-    print(str(db.brooklyn.find().count()))
+    print('db.brooklyn.count_documents({})')
+    print(str(db.brooklyn.count_documents({})))
     
     print('\nNumber of \'way\' type documents: ')
-    print('db.brooklyn.find({\'type\' :\'way\'}).count()')
-    print(str(db.brooklyn.find({'type' :'way'}).count()))
+    print('db.brooklyn.count_documents({\'type\' :\'way\'})')
+    print(str(db.brooklyn.count_documents({'type' :'way'})))
     
     print('\nNumber of \'node\' type documents: ')
-    print('db.brooklyn.find({\'type\' :\'node\'}).count()')
-    print(str(db.brooklyn.find({'type' :'node'}).count()))
+    print('db.brooklyn.count_documents({\'type\' :\'node\'})')
+    print(str(db.brooklyn.count_documents({'type' :'node'})))
+
+    print('\nNumber of \'relation\' type documents: ')
+    print('db.brooklyn.count_documents({\'type\' :\'relation\'})')
+    print(str(db.brooklyn.count_documents({'type' :'relation'})))
+
+    print('\nNumber of \'relation\' type documents with assembled geometry: ')
+    print('db.brooklyn.count_documents({\'type\' :\'relation\', \'geometry\' :{\'$exists\':1}})')
+    print(str(db.brooklyn.count_documents({'type' :'relation', 'geometry' :{'$exists':1}})))
+
+    if partition_output:
+        print('\nNumber of documents in Brooklyn Heights bounding box tiles: ')
+        bbox_tiles = partitioner.getBboxTiles(40.690, -74.000, 40.703, -73.990)
+        print('db.brooklyn.count_documents({\'tile\' :{\'$in\':' + str(bbox_tiles) + '}})')
+        print(str(db.brooklyn.count_documents({'tile' :{'$in':bbox_tiles}})))
     
+    # Reports are read from the report views maintained by the loader,
+    # instead of aggregating the full collection each time
     print('\nNumber of unique users: ')
-    print('len(db.brooklyn.distinct(\'created.user\'))')
-    print(str(len(db.brooklyn.distinct('created.user'))))
+    print('db.brooklyn_reports.count_documents({\'report\' :\'user\', \'count\' :{\'$gt\':0}})')
+    print(str(views.distinct('user')))
                                                 
     print('\nTop 1 contributing user: ')
-    top_contributor_pipeline = [{'$group':
-                                    {'_id':'$created.user', 
-                                     'count':{'$sum':1}}}, 
-                                {'$sort':
-                                    {'count':1}}, 
-                                {'$limit':1}]
-    print('db.brooklyn.aggregate(' + str(top_contributor_pipeline) + ')')
-    top_contributor = mongoAggregate(db.brooklyn.aggregate(top_contributor_pipeline))
+    print('db.brooklyn_reports.find({\'report\' :\'user\'}).sort(\'count\', 1).limit(1)')
+    top_contributor = views.top('user', limit=1, ascending=True)
     print(str(top_contributor[0]))
                                                 
     print('\nNumber of users appearing only once (having 1 post): ')
-    unique_user_count_pipeline =[{'$group':
-                                     {'_id':'$created.user', 
-                                      'count':{'$sum':1}}}, 
-                                {'$group':
-                                    {'_id':'$count', 
-                                     'num_users':{'$sum':1}}}, 
-                                {'$sort':
-                                    {'_id':1}}, 
-                                {'$limit':1}]                                    
-    print('db.brooklyn.aggregate(' + str(unique_user_count_pipeline) + ')')
-    unique_user_count = mongoAggregate(db.brooklyn.aggregate(unique_user_count_pipeline))
-    print(str(unique_user_count[0]))
-
+    print('db.brooklyn_reports.find({\'report\' :\'user\'}).sort(\'count\', 1).limit(1)')
+    print('db.brooklyn_reports.count_documents({\'report\' :\'user\', \'count\' :count})')
+    lowest_count, num_users = views.rarest('user')
+    print(str({'_id' : lowest_count, 'num_users' : num_users}))
                        
     print('\nTop 10 appearing amenities: ')
-    top_10_amenities_pipeline = [{'$match':
-                                     {'amenity':{'$exists':1}}}, 
-                                 {'$group':
-                                     {'_id':'$amenity', 
-                                      'count':{'$sum':1}}}, 
-                                {'$sort':
-                                     {'count':1}}, 
-                                {"$limit":10}]
-    print('db.brooklyn.aggregate(' + str(top_10_amenities_pipeline) + ')')
-    top_10_amenities = mongoAggregate(db.brooklyn.aggregate(top_10_amenities_pipeline))
+    print('db.brooklyn_reports.find({\'report\' :\'amenity\'}).sort(\'count\', 1).limit(10)')
+    top_10_amenities = views.top('amenity', limit=10, ascending=True)
     print(str(top_10_amenities))
                                         
     print('\nHighest population religion: ')
-    most_pop_religion_pipeline = [{'$match':
-                                      {'amenity':{'$exists':1}, 
-                                       'amenity':'place_of_worship'}}, 
-                                  {'$group':
-                                      {'_id':'$religion', 
-                                       'count':{'$sum':1}}}, 
-                                  {'$sort':
-                                      {'count':1}}, 
-                                  {'$limit':1}]
-    print('db.brooklyn.aggregate(' + str(most_pop_religion_pipeline) + ')')
-    most_pop_religion = mongoAggregate(db.brooklyn.aggregate(most_pop_religion_pipeline))
+    print('db.brooklyn_reports.find({\'report\' :\'religion\'}).sort(\'count\', 1).limit(1)')
+    most_pop_religion = views.top('religion', limit=1, ascending=True)
     print(str(most_pop_religion[0]))
                                              
     print('\nMost popular cuisines: ')
-    most_pop_cuisine_pipeline = [{'$match':
-                                     {'amenity':{'$exists':1}, 
-                                      'amenity':'restaurant'}}, 
-                                 {'$group':
-                                     {'_id':'$cuisine', 
-                                     'count':{'$sum':1}}}, 
-                                 {'$sort':
-                                     {'count':1}}, 
-                                {'$limit':2}]          
-    print('db.brooklyn.aggregate(' + str(most_pop_cuisine_pipeline) + ')')
-    most_pop_cuisine = mongoAggregate(db.brooklyn.aggregate(most_pop_cuisine_pipeline))
+    print('db.brooklyn_reports.find({\'report\' :\'cuisine\'}).sort(\'count\', 1).limit(2)')
+    most_pop_cuisine = views.top('cuisine', limit=2, ascending=True)
     print(str(most_pop_cuisine[0]))
     
     print('\nPostal Codes: ')
-    postal_codes_pipeline = [{'$match':
-                                 {'address.postcode':{'$exists':1},
-                                  'address.postcode':'NaN'}}, 
-                             {'$group':
-                                 {'_id':'$address.postcode', 
-                                  'count':{'$sum':1}}}, 
-                             {'$sort':{'count':1}}]
-    print('db.brooklyn.aggregate(' + str(postal_codes_pipeline) + ')')                             
-    postal_codes = mongoAggregate(db.brooklyn.aggregate(postal_codes_pipeline))
-    print(str(postal_codes[0]))
\ No newline at end of file
+    print('db.brooklyn_reports.find_one({\'_id\' :{\'report\' :\'postcode\', \'key\' :\'NaN\'}})')
+    postal_codes = views.count('postcode', 'NaN')
+    print(str(postal_codes))
+
+    # Check the report views against the aggregation pipelines over the
+    # full collection, and rebuild them if they drifted. A resumed load can
+    # leave the views off, so they are always checked then
+    if check_views or loader.isResumed():
+        print('\nChecking report views against aggregation pipelines...')
+        for report in views.getReports():
+            print('db.brooklyn.aggregate(' + str(views.getPipeline(report)) + ')')
+        mismatches = views.check()
+        if mismatches:
+            print('Report views differ from aggregation pipelines, rebuilding: ')
+            pprint.pprint(mismatches)
+            views.rebuild()
+        else:
+            print('Report views match aggregation pipelines.')
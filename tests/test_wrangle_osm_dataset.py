@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of Wrangle OSM Dataset.py
+
+Run with python -m pytest tests, or python -m unittest discover tests
+'''
+
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+MODULE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, 'Wrangle OSM Dataset.py')
+
+# The script name has spaces, so it is loaded from its file. It is added to
+# sys.modules first, so multiprocessing workers can find scanChunk
+spec = importlib.util.spec_from_file_location('wrangle_osm_dataset', MODULE_FILE)
+wrangle = importlib.util.module_from_spec(spec)
+sys.modules['wrangle_osm_dataset'] = wrangle
+spec.loader.exec_module(wrangle)
+
+
+class PostcodeTest(unittest.TestCase):
+    '''
+    PostcodeIndex lookups and CleanStreets postcode suggestions
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.boundary_file = os.path.join(self.tmp_dir, 'boundaries.geojson')
+
+        # 11201 has a hole, filled by 11205
+        boundaries = {'type' : 'FeatureCollection', 'features' : [
+            {'type' : 'Feature',
+             'properties' : {'ZCTA5CE10' : '11201'},
+             'geometry' : {'type' : 'Polygon', 'coordinates' : [
+                 [[-74.00, 40.68], [-73.98, 40.68], [-73.98, 40.70], [-74.00, 40.70], [-74.00, 40.68]],
+                 [[-73.995, 40.685], [-73.985, 40.685], [-73.985, 40.695], [-73.995, 40.695],
+                  [-73.995, 40.685]]]}},
+            {'type' : 'Feature',
+             'properties' : {'ZCTA5CE10' : '11205'},
+             'geometry' : {'type' : 'MultiPolygon', 'coordinates' : [[
+                 [[-73.995, 40.685], [-73.985, 40.685], [-73.985, 40.695], [-73.995, 40.695],
+                  [-73.995, 40.685]]]]}}]}
+        with open(self.boundary_file, 'w') as f:
+            json.dump(boundaries, f)
+
+        self.postcode_index = wrangle.PostcodeIndex(self.boundary_file)
+        self.cleanSt = wrangle.CleanStreets('sample.osm', self.postcode_index)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def testFindPostcode(self):
+        self.assertEqual(self.postcode_index.findPostcode(40.682, -73.998), '11201')
+        self.assertEqual(self.postcode_index.findPostcode(40.690, -73.990), '11205')
+        self.assertIsNone(self.postcode_index.findPostcode(40.710, -73.990))
+
+
+    def testZipCodeIsKeptAndSuggested(self):
+        self.assertEqual(self.cleanSt.cleanZip('11201', [40.682, -73.998]), ('11201', None))
+        self.assertEqual(self.cleanSt.cleanZip('11201', [40.690, -73.990]), ('11201', '11205'))
+        self.assertEqual(self.cleanSt.cleanZip('11201', [40.710, -73.990]), ('11201', None))
+        self.assertEqual(self.cleanSt.cleanZip('abc', [40.690, -73.990]), ('NaN', '11205'))
+        self.assertEqual(self.cleanSt.cleanZip('abc'), ('NaN', None))
+
+
+    def testAuditReportsSuggestion(self):
+        zip_types = wrangle.defaultdict(set)
+        self.cleanSt.auditZipType(zip_types, '11201', [40.690, -73.990])
+        self.cleanSt.auditZipType(zip_types, '11205', [40.690, -73.990])
+        self.assertEqual(dict(zip_types), {'11201' : set(['11205'])})
+
+
+class FuzzyCleanTest(unittest.TestCase):
+    '''
+    CleanStreets.fuzzyClean and StreetIndex
+    '''
+    def setUp(self):
+        self.street_counts = wrangle.Counter({'Flatbush Avenue' : 1000,
+                                              'Flatbsh Avenue' : 3,
+                                              'Atlantic Avenue' : 500,
+                                              'Atlantc Avenue' : 2,
+                                              'East 8th Street' : 400,
+                                              'West 8th Street' : 30,
+                                              'Dean Street' : 400,
+                                              'Bean Street' : 3,
+                                              'Bergen Street' : 400,
+                                              'Berger Street' : 30})
+        self.cleanSt = wrangle.CleanStreets('sample.osm')
+        self.clean_streets_dict = self.cleanSt.fuzzyClean(self.street_counts)
+
+
+    def testRepeatedMisspellingsAreReplaced(self):
+        self.assertEqual(self.clean_streets_dict['Flatbsh Avenue'], 'Flatbush Avenue')
+        self.assertEqual(self.clean_streets_dict['Atlantc Avenue'], 'Atlantic Avenue')
+        canonical = self.cleanSt.getStreetIndex().getCanonical().values()
+        self.assertNotIn('Flatbsh Avenue', canonical)
+        self.assertNotIn('Atlantc Avenue', canonical)
+
+
+    def testDirectionsMustMatch(self):
+        self.assertNotIn('West 8th Street', self.clean_streets_dict)
+        self.assertNotIn('West 8th Street', self.cleanSt.getSuggestions())
+
+
+    def testShortBodiesAreOnlySuggested(self):
+        self.assertNotIn('Bean Street', self.clean_streets_dict)
+        self.assertNotIn('Berger Street', self.clean_streets_dict)
+        self.assertEqual(self.cleanSt.getSuggestions()['Bean Street'][0], 'Dean Street')
+        self.assertEqual(self.cleanSt.getSuggestions()['Berger Street'][0], 'Bergen Street')
+
+
+class RawAuditTest(unittest.TestCase):
+    '''
+    CleanStreets.auditRaw against CleanStreets.audit
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.osm_file = os.path.join(cls.tmp_dir, 'audit.osm')
+        streets = ['Flatbush Ave', 'Main St.', 'Bedford Avenue', 'O&apos;Brien Street',
+                   'Caf&#233; &amp; Co Street']
+        postcodes = ['11201', '10001', '11205', 'abc']
+
+        with open(cls.osm_file, 'w') as f:
+            f.write("<?xml version='1.0' encoding='UTF-8'?>\n<osm>\n")
+            for i in range(3000):
+                kind = ['node', 'way', 'node', 'relation'][i % 4]
+                if kind == 'node':
+                    f.write('  <node id="{0}" lat="40.6{1}" lon="-73.9{1}">\n'.format(i, i % 10))
+                else:
+                    f.write('  <{0} id="{1}" version="1">\n'.format(kind, i))
+                if kind == 'relation':
+                    # Relation tags must never be counted for a node or way
+                    f.write('    <tag k="addr:street" v="Rel St"/>\n')
+                    f.write('    <tag k="addr:postcode" v="99999"/>\n')
+                else:
+                    if i % 3:
+                        f.write('    <tag k="addr:street" v="{0}"/>\n'.format(streets[i % 5]))
+                    if i % 2:
+                        f.write("    <tag k='addr:postcode' v='{0}'/>\n".format(postcodes[i % 4]))
+                f.write('  </{0}>\n'.format(kind))
+            f.write('</osm>\n')
+
+        cls.tree = wrangle.CleanStreets(cls.osm_file)
+        cls.tree_results = cls.tree.audit(cls.osm_file)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+
+    def testProcessCountsMatchTreeAudit(self):
+        for processes in [1, 2, 3, 7, 11, 13, 17, 29, 64]:
+            raw = wrangle.CleanStreets(self.osm_file)
+            raw_results = raw.auditRaw(self.osm_file, processes)
+            self.assertEqual(raw_results, self.tree_results, processes)
+            self.assertEqual(raw.getStreetCounts(), self.tree.getStreetCounts(), processes)
+            self.assertEqual(raw.getStats(), self.tree.getStats(), processes)
+            self.assertNotIn('Rel St', raw.getStreetCounts())
+
+
+    def testChunkStartInsideOpeningTag(self):
+        with open(self.osm_file, 'rb') as f:
+            mm = wrangle.mmap.mmap(f.fileno(), 0, access=wrangle.mmap.ACCESS_READ)
+            try:
+                opened = mm.find(b'<relation')
+                for start in range(opened + 1, opened + len(b'<relation id=')):
+                    self.assertEqual(wrangle.findOpenElement(mm, start, window=16), opened)
+                self.assertLess(wrangle.findOpenElement(mm, opened), opened)
+            finally:
+                mm.close()
+
+
+class DeduplicatorTest(unittest.TestCase):
+    '''
+    Deduplicator merge of overlapping extracts
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dedup = wrangle.Deduplicator(os.path.join(self.tmp_dir, 'dedup.sqlite'))
+
+
+    def tearDown(self):
+        self.dedup.close()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def writeJson(self, name, lines):
+        json_file = os.path.join(self.tmp_dir, name)
+        with open(json_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return json_file
+
+
+    def testMergeKeepsHighestVersion(self):
+        old_file = self.writeJson('old.json', [
+            '{"type": "node", "id": "1", "created": {"version": "1"}}',
+            '{"type": "node", "id": "2", "created": {"version": "4"}, "name": "a"}',
+            '{"type": "node", "id": "3", "created": {"version": "1"}}'])
+        new_file = self.writeJson('new.json', [
+            '{"type": "node", "id": "1", "created": {"version": "2"}}',
+            '{"type": "node", "id": "2", "created": {"version": "3"}}',
+            '{"type": "node", "id": "3", "created": {"version": "1"}}',
+            '{"type": "node", "id": "4", "created": {"version": "1"}}'])
+        merged_file = os.path.join(self.tmp_dir, 'merged.json')
+
+        self.dedup.scan([old_file, new_file])
+        self.assertEqual(self.dedup.merge([old_file, new_file], merged_file), 4)
+
+        with open(merged_file) as f:
+            versions = dict((doc['id'], doc['created']['version'])
+                            for doc in (json.loads(line) for line in f))
+        self.assertEqual(versions, {'1' : '2', '2' : '4', '3' : '1', '4' : '1'})
+        self.assertEqual(self.dedup.getStats()['unique'], 4)
+        self.assertEqual(self.dedup.getStats()['duplicates'], 1)
+
+
+    def testStaleVersionNamesItsFile(self):
+        old_file = self.writeJson('old.json', [
+            '{"type": "node", "id": "1", "created": {"version": "1"}}',
+            '{"type": "node", "id": "2", "created": {"version": "4"}}'])
+        new_file = self.writeJson('new.json', [
+            '{"type": "node", "id": "1", "created": {"version": "2"}}',
+            '{"type": "node", "id": "2", "created": {"version": "3"}}'])
+
+        self.dedup.scan([old_file, new_file])
+        self.assertEqual(sorted(self.dedup.getConflicts()),
+                         [('node:1', 'stale', 2, 1, old_file),
+                          ('node:2', 'stale', 4, 3, new_file)])
+
+
+@unittest.skipIf(mongomock is None, 'mongomock is not installed')
+class MongoLoaderTest(unittest.TestCase):
+    '''
+    MongoLoader against a mocked MongoDB server
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = mongomock.MongoClient().osm_results
+        self.views = wrangle.ReportViews(self.db.brooklyn, self.db.brooklyn_reports)
+        self.loader = wrangle.MongoLoader(self.db.brooklyn, views=self.views)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def writeJson(self, name, lines):
+        json_file = os.path.join(self.tmp_dir, name)
+        with open(json_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return json_file
+
+
+    def testStaleVersionsAreRejected(self):
+        self.loader.load(self.writeJson('a.json', [
+            '{"type": "node", "id": "1", "created": {"version": "5", "user": "a"}}']))
+        self.loader.load(self.writeJson('b.json', [
+            '{"type": "node", "id": "1", "created": {"version": "3", "user": "b"}}',
+            '{"type": "node", "id": "2", "created": {"version": "1", "user": "b"}}',
+            '{"type": "node", "id": "2", "created": {"version": "2", "user": "c"}}',
+            '{"type": "node", "id": "2", "created": {"version": "1", "user": "d"}}']))
+
+        node_1 = self.db.brooklyn.find_one({'type' : 'node', 'id' : '1'})
+        node_2 = self.db.brooklyn.find_one({'type' : 'node', 'id' : '2'})
+        self.assertEqual(node_1['created']['user'], 'a')
+        self.assertEqual(node_1['osm_version'], 5)
+        self.assertEqual(node_2['created']['user'], 'c')
+        self.assertEqual(self.db.brooklyn.count_documents({}), 2)
+        self.assertEqual(self.loader.getStats()['stale'], 3)
+        self.assertEqual(self.views.check(), {})
+
+
+    def testNewerAndSameVersionsReplace(self):
+        self.loader.load(self.writeJson('a.json', [
+            '{"type": "node", "id": "1", "created": {"version": "5", "user": "a"}}']))
+        self.loader.load(self.writeJson('b.json', [
+            '{"type": "node", "id": "1", "created": {"version": "5", "user": "b"}}']))
+        self.loader.load(self.writeJson('c.json', [
+            '{"type": "node", "id": "1", "created": {"version": "6", "user": "c"}}']))
+
+        node_1 = self.db.brooklyn.find_one({'type' : 'node', 'id' : '1'})
+        self.assertEqual(node_1['created']['user'], 'c')
+        self.assertEqual(self.loader.getStats()['stale'], 0)
+        self.assertEqual(self.views.top('user'), [{'_id' : 'c', 'count' : 1}])
+
+
+    def testResumedLoadViewsAreRepaired(self):
+        json_file = self.writeJson('a.json', [
+            '{"type": "node", "id": "1", "created": {"version": "1", "user": "a"}}',
+            '{"type": "node", "id": "2", "created": {"version": "1", "user": "b"}}'])
+        checkpoint = wrangle.Checkpoint(os.path.join(self.tmp_dir, 'checkpoint.json'))
+        loader = wrangle.MongoLoader(self.db.brooklyn, checkpoint, batch_size=1, views=self.views)
+        update = self.views.update
+        calls = []
+
+        # Crash after the second batch is written, before its views update
+        def crashingUpdate(old_docs, new_docs):
+            calls.append(len(calls))
+            if len(calls) == 2:
+                raise KeyboardInterrupt()
+            update(old_docs, new_docs)
+
+        self.views.update = crashingUpdate
+        self.assertRaises(KeyboardInterrupt, loader.load, json_file)
+        self.views.update = update
+        self.assertFalse(loader.isResumed())
+
+        loader = wrangle.MongoLoader(self.db.brooklyn, checkpoint, batch_size=1, views=self.views)
+        loader.load(json_file)
+        self.assertTrue(loader.isResumed())
+        self.assertEqual(self.views.check(), {'type' : [('node', 1, 2)],
+                                              'user' : [('b', 0, 1)]})
+        self.views.rebuild()
+        self.assertEqual(self.views.check(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()